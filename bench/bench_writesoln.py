@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015, Geoffrey M. Poore
+# All rights reserved.
+#
+# Licensed under the BSD 3-Clause License:
+# http://opensource.org/licenses/BSD-3-Clause
+#
+
+
+'''
+Benchmark for the default solution writer, ``_writesoln()``.
+
+Synthetic data is generated with a given number of students, attempts,
+problems, and parts, and solutions are written with both the current
+``_writesoln()`` and the reference renderer below, which is the renderer from
+RandAssign 1.0 that calls ``str.format()`` for every solution.  The outputs
+are checked for equality.
+
+Usage::
+
+    python bench/bench_writesoln.py [--students N] [--attempts N]
+                                    [--problems N] [--parts N] [--fmt tex|md]
+                                    [--repeat N]
+
+The defaults give 3000 students x 3 attempts x 10 problems (one with a single
+part and the rest with 4 parts), or 333,000 solution entries.
+'''
+
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+
+import os
+import sys
+if sys.version_info.major == 2:
+    from io import open
+    str = unicode
+import argparse
+import importlib
+import random
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# The package exports the function `make()`, which hides the module
+make = importlib.import_module('randassign.make')
+
+
+
+
+def synthetic_data(students, attempts, problems, parts, seed=0):
+    '''
+    Data in the form saved in the data file, with solutions in "addsoln"
+    format.  Odd-numbered problems have info and even-numbered problems do
+    not; problem 1 has a single part.
+    '''
+    r = random.Random(seed)
+    data = {}
+    for n in range(students):
+        student_raw_str = 'Last{0:05d}, First{0:05d}'.format(n)
+        solutions = []
+        for _ in range(attempts):
+            solnset = []
+            for number in range(1, problems+1):
+                nparts = 1 if number == 1 else parts
+                solution = [r.choice([r.randint(1, 1000), round(r.random(), 4), 'x = {0}'.format(r.randint(1, 9))]) for _ in range(nparts)]
+                solnset.append({'number': number,
+                                'info': 'Problem {0}'.format(number) if number % 2 else '',
+                                'solution': solution})
+            solutions.append(solnset)
+        data[student_raw_str] = {'name': 'First{0:05d} Last{0:05d}'.format(n),
+                                 'name_raw': student_raw_str,
+                                 'solutions': solutions}
+    return data
+
+
+def templates(fmt):
+    suffix = '_tex' if fmt == 'tex' else '_md'
+    names = ['doc', 'student', 'solnsattempt', 'solnswrapper', 'solnsingle',
+             'solnsingleinfo', 'solnmultiwrapper', 'solnmultiwrapperinfo',
+             'solnmulti']
+    return {'solntemplate' + k: getattr(make, '_solntemplate' + k + suffix) for k in names}
+
+
+
+
+def reference_writesoln(data, solnfile, onlylastsoln=False, multipleattempts=True,
+                        solntemplatedoc=None,
+                        solntemplatestudent=None,
+                        solntemplatesolnsattempt=None,
+                        solntemplatesolnswrapper=None,
+                        solntemplatesolnsingle=None,
+                        solntemplatesolnsingleinfo=None,
+                        solntemplatesolnmultiwrapper=None,
+                        solntemplatesolnmultiwrapperinfo=None,
+                        solntemplatesolnmulti=None):
+    '''
+    Renderer from RandAssign 1.0.
+    '''
+    allsolutions = []
+    for student_raw_str in sorted((k for k in data), key=lambda x: x.split(',')[0]):
+        if onlylastsoln:
+            solns = [data[student_raw_str]['solutions'][-1]]
+            attempts = [len(data[student_raw_str]['solutions'])]
+        else:
+            solns = data[student_raw_str]['solutions']
+            attempts = [n for n in range(1, len(data[student_raw_str]['solutions'])+1)]
+        if not multipleattempts:
+            attempts = [None]
+
+        studentsolutions = []
+        for attempt, solnset in zip(attempts, solns):
+            solution = []
+            wrapper = True
+            for n, s in enumerate(solnset):
+                if isinstance(s, str):
+                    solution.append(s)
+                    wrapper = False
+                elif isinstance(s, dict):
+                    if len(s['solution']) == 1:
+                        if s['info']:
+                            solution.append(solntemplatesolnsingleinfo.format(number=s['number'], info=s['info'], solution=s['solution'][0]))
+                        else:
+                            solution.append(solntemplatesolnsingle.format(number=s['number'], solution=s['solution'][0]))
+                    else:
+                        if s['info']:
+                            solution.append(solntemplatesolnmultiwrapperinfo.format(number=s['number'], info=s['info'], solution=''.join(solntemplatesolnmulti.format(solution=x) for x in s['solution'])))
+                        else:
+                            solution.append(solntemplatesolnmultiwrapper.format(number=s['number'], solution=''.join(solntemplatesolnmulti.format(solution=x) for x in s['solution'])))
+                else:
+                    raise RuntimeError('Invalid solution format')
+
+            if wrapper:
+                solution = solntemplatesolnswrapper.format(solution=''.join(solution))
+            else:
+                solution = ''.join(solution)
+            if attempt is not None:
+                solution = solntemplatesolnsattempt.format(attempt=attempt) + solution
+
+            studentsolutions.append(solution)
+
+        allsolutions.append(solntemplatestudent.format(name=student_raw_str, solution=''.join(studentsolutions)))
+
+    with open(solnfile, 'w', encoding='utf8') as f:
+        f.write(solntemplatedoc.format(solution=''.join(allsolutions)))
+
+
+
+
+def best(f, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.time()
+        f()
+        times.append(time.time() - t)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the default solution writer')
+    parser.add_argument('--students', type=int, default=3000)
+    parser.add_argument('--attempts', type=int, default=3)
+    parser.add_argument('--problems', type=int, default=10)
+    parser.add_argument('--parts', type=int, default=4)
+    parser.add_argument('--fmt', default='tex', choices=['tex', 'md'])
+    parser.add_argument('--onlylastsoln', action='store_true')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    data = synthetic_data(args.students, args.attempts, args.problems, args.parts)
+    entries = sum(len(s['solution']) for v in data.values() for solnset in v['solutions'] for s in solnset)
+    kwargs = templates(args.fmt)
+    tempdir = tempfile.mkdtemp()
+    try:
+        reffile = os.path.join(tempdir, 'reference.' + args.fmt)
+        newfile = os.path.join(tempdir, 'current.' + args.fmt)
+        t_ref = best(lambda: reference_writesoln(data, reffile, onlylastsoln=args.onlylastsoln, **kwargs), args.repeat)
+        t_new = best(lambda: make._writesoln(data, solnfile=newfile, solnfmt=args.fmt,
+                                             onlylastsoln=args.onlylastsoln,
+                                             multipleattempts=True, **kwargs), args.repeat)
+        with open(reffile, encoding='utf8') as f:
+            ref = f.read()
+        with open(newfile, encoding='utf8') as f:
+            new = f.read()
+        if ref != new:
+            sys.exit('Outputs differ')
+        print('{0} students, {1} solution entries, {2:.1f} MB of {3}'.format(len(data), entries, len(new.encode('utf8'))/1e6, args.fmt))
+        print('reference:  {0:.3f} s'.format(t_ref))
+        print('current:    {0:.3f} s  ({1:.2f}x)'.format(t_new, t_ref/t_new))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
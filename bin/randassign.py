@@ -8,5 +8,6 @@
 #
 
 
-from randassign import make
-make()
+import sys
+from randassign.make import main
+sys.exit(main())
@@ -12,7 +12,12 @@ from __future__ import (division, print_function, absolute_import,
                         unicode_literals)
 
 
+import sys
+
 from .version import __version__, __version_info__
 
 from .latex import RandAssign
-from .make import make
+from .progress import ProgressSnapshot, ProgressPoller
+from .make import make, iter_make, release, assignpath, MakeReport, StudentResult, BuildError
+if sys.version_info >= (3, 5):
+    from .aio import make_async
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015, Geoffrey M. Poore
+# All rights reserved.
+#
+# Licensed under the BSD 3-Clause License:
+# http://opensource.org/licenses/BSD-3-Clause
+#
+
+
+'''
+Version of ``make()`` for use with asyncio.  Requires Python 3.5+.
+'''
+
+
+import asyncio
+import os
+import subprocess
+import time
+from .make import (_process_args, _MakeRun, _buildlockfile, _newseed,
+                   _retryfile, _write_retryfile, _logdir, _bundledir, _rotate_log,
+                   _OutputCapture, _show_tail, MakeReport)
+from .lock import FileLock
+
+
+
+
+async def make_async(events=None, **kwargs):
+    '''
+    Generate randomized assignments and solutions, running LaTeX, PythonTeX,
+    and the solution command as asyncio subprocesses.
+
+    Standard usage::
+
+        from randassign import make_async
+        await make_async(texfile='<tex_file>', jobs=4)
+
+    Accepts the same keyword arguments as ``make()``.  Up to ``jobs``
+    students are built simultaneously.
+
+    Returns a ``MakeReport`` summarizing the run.  If ``events`` is an
+    ``asyncio.Queue``, then a ``StudentResult`` is put into it as each
+    student's assignment is completed, and ``None`` is put into it once all
+    assignments are complete.
+
+    If the task running ``make_async()`` is cancelled, any running commands
+    are killed, and the students whose assignments were incomplete are rolled
+    back.  Completed assignments are kept and saved in the data file, and the
+    solution file is written, but the solution command is not run; the
+    solutions may be updated later with ``onlysolutions``.  If any other
+    error occurs, everything created during the run is discarded, as with
+    ``make()``.
+    '''
+    start = time.time()
+    a = _process_args(kwargs)
+    if a.watch:
+        raise RuntimeError('Option "watch" is only supported by watch() and the command-line utility')
+    if a.serve:
+        raise RuntimeError('Option "serve" is only supported by serve() and the command-line utility')
+    if a.release:
+        raise RuntimeError('Option "release" is only supported by release() and the command-line utility')
+    run = _MakeRun(a)
+    report = MakeReport()
+    report.solnfile = a.solnfile
+    report.datafile = a.randassigndatafile
+    retryfile = _retryfile(a)
+    try:
+        run.start()
+        if run.sink is not None:
+            report.archive = run.sink.path
+        if not a.onlysolutions:
+            run.progress.phase('build', total=len(run.students))
+            if a.isolate:
+                await _build(run, run.slots(run.jobs()), events, report)
+            else:
+                buildlock = FileLock(os.path.join(a.texdir, _buildlockfile), silent=a.silent)
+                await _acquire(buildlock)
+                try:
+                    await _build(run, run.slots(run.jobs()), events, report)
+                finally:
+                    buildlock.release()
+        if events is not None:
+            await events.put(None)
+
+        run.closesink()
+        cmds = run.closebundle()
+        if cmds:
+            run.progress.phase('bundle')
+            logfile = os.path.abspath(os.path.join(_logdir(a), 'bundle.log'))
+            _rotate_log(logfile)
+            with run.tracer.span('bundle'):
+                for cmd in cmds:
+                    await _call(cmd, a.verbose, cwd=_bundledir(a), logfile=logfile, silent=a.silent)
+            report.bundle = run.bundle.pdffile
+        await _acquire(run.datalock)
+        try:
+            with run.tracer.span('merge data'):
+                run.merge()
+            run.progress.phase('solutions')
+            with run.tracer.span('solutions'):
+                run.writesoln(None)
+                if a.solncmd:
+                    logfile = os.path.abspath(os.path.join(_logdir(a), 'solutions.log'))
+                    _rotate_log(logfile)
+                    await _call(a.solncmd, a.verbose, cwd=a.solndir or None, logfile=logfile, silent=a.silent)
+            run.progress.phase('save')
+            with run.tracer.span('save data'):
+                run.save()
+        finally:
+            run.datalock.release()
+        run.commit()
+        run.progress.phase('done')
+    except asyncio.CancelledError:
+        if run.added or run.reserved:
+            # The print bundle is left for compiling manually
+            if run.bundle is not None:
+                run.bundle.close()
+            run.closesink()
+            await _acquire(run.datalock)
+            try:
+                run.merge()
+                run.writesoln(None)
+                run.save()
+            finally:
+                run.datalock.release()
+            run.commit()
+            run.progress.phase('done')
+        else:
+            run.rollback()
+        raise
+    except:
+        run.rollback()
+        raise
+    if report.failed:
+        report.retryfile = _write_retryfile(retryfile, report.failed, a.silent)
+    report.elapsed = time.time() - start
+    return report
+
+
+
+
+async def _build(run, slots, events, report):
+    '''
+    Build assignments for all students in ``run``, using each slot for one
+    student at a time, and collect the results in ``report``.
+    '''
+    a = run.a
+    free = asyncio.Queue()
+    for slot in slots:
+        free.put_nowait(slot)
+
+    async def build_student(n):
+        slot = await free.get()
+        try:
+            seed = None
+            tries = 0
+            while True:
+                start = time.time()
+                timings = {}
+                attempt = None
+                try:
+                    attempt = run.prepare_student(slot, n)
+                    env = slot.environ(seed)
+                    logfile = run.logfile(n, attempt)
+                    for label, cmd in run.steps(slot):
+                        cmd = run.command(slot, label, cmd)
+                        run.progress.step(run.students[n], label, attempt)
+                        t = time.time()
+                        await _call(cmd, a.verbose, cwd=slot.dir, env=env, logfile=logfile)
+                        run.command_done(slot, label, cmd, t, timings)
+                    slot.primed = True
+                    result = run.finish_student(slot, n, attempt, timings, start, logfile)
+                    run.trace_student(slot, n, attempt, tries, start)
+                    break
+                except asyncio.CancelledError:
+                    # Under Python < 3.8, this is an `Exception`, but a
+                    # cancelled build is neither retried nor a failure
+                    raise
+                except Exception:
+                    run.trace_student(slot, n, attempt, tries, start, failed=True)
+                    result = run.failure(slot, n, tries, attempt, timings, start)
+                    if result is not None:
+                        break
+                tries += 1
+                seed = _newseed()
+        finally:
+            free.put_nowait(slot)
+        run.progress.finish(run.students[n], failed=result.error is not None, attempt=result.attempt)
+        report.results.append(result)
+        if events is not None:
+            await events.put(result)
+
+    # Tasks wait for free slots in the order in which they are created
+    tasks = [asyncio.ensure_future(build_student(n)) for n in run.order()]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the remaining builds, and wait for their commands to be killed
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+
+
+async def _acquire(lock):
+    '''
+    Acquire the ``FileLock`` ``lock`` without blocking the event loop.  The
+    lock is polled rather than acquired in a worker thread, since a thread
+    would still acquire the lock after the waiting task had been cancelled,
+    and nothing would release it.
+    '''
+    if lock.acquire(blocking=False):
+        return
+    lock._wait_message()
+    while not lock.acquire(blocking=False):
+        await asyncio.sleep(lock.poll)
+
+
+
+
+async def _call(cmd, verbose, cwd=None, env=None, logfile=None, silent=True):
+    '''
+    Run a command as an asyncio subprocess, appending its output to
+    ``logfile``, as with ``randassign.make._call()``.  The command is killed
+    if the calling task is cancelled.
+    '''
+    if verbose:
+        if logfile is None:
+            print('Running command {0}'.format(cmd))
+        else:
+            print('Running command {0} (log "{1}")'.format(cmd, logfile))
+    capture = _OutputCapture(cmd, logfile)
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, env=env,
+                                                    stdout=subprocess.PIPE,
+                                                    stderr=subprocess.STDOUT)
+        try:
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+                capture.write(line)
+            returncode = await proc.wait()
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+    finally:
+        capture.close()
+    if returncode:
+        e = capture.error(returncode)
+        _show_tail(e, silent)
+        raise e
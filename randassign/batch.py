@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015, Geoffrey M. Poore
+# All rights reserved.
+#
+# Licensed under the BSD 3-Clause License:
+# http://opensource.org/licenses/BSD-3-Clause
+#
+
+
+'''
+Building several documents together, for ``make()`` with a list of tex files
+or a manifest.
+'''
+
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+
+import os
+import collections
+import threading
+import time
+from .make import (argv_parser, _process_args, _MakeRun, _BuildSlot,
+                   _make_builddir, _check_directory_structure, _load_students, _parsestudentfile,
+                   _parsestudentname, _rosterfile, _retryfile,
+                   _write_retryfile, MakeReport)
+from .progress import Progress, TerminalProgress
+
+
+
+
+class _DocumentProgress(object):
+    '''
+    Progress of one document within a batch.  Builds are passed to the
+    progress of the whole batch, labeled with the document, while the phases
+    of the document (solutions, saving data) are not shown, since other
+    documents are still being built.
+    '''
+    def __init__(self, progress, name):
+        self.progress = progress
+        self.name = name
+
+    def phase(self, name, total=None):
+        pass
+
+    def step(self, student, step, attempt=None):
+        self.progress.step('{0}: {1}'.format(self.name, student), step, attempt)
+
+    def finish(self, student, failed=False, attempt=None):
+        self.progress.finish('{0}: {1}'.format(self.name, student), failed, attempt)
+
+    def snapshot(self):
+        return self.progress.snapshot()
+
+
+
+
+def make_batch(texfiles, kwargs):
+    '''
+    Build ``texfiles`` together, for the same students, and return a list of
+    ``MakeReport``, one for each document.
+
+    Each document is a separate run, with its own data and solutions, which
+    proceeds as with ``make()``.  The student file is only loaded once.  All
+    (document, student) builds share a pool of ``jobs`` workers, which build
+    the documents in order.  When a document's last build is complete, the
+    worker that completed it merges the data and generates the solutions
+    for that document while the other workers move on to the next
+    documents, so that no workers sit idle while solutions are compiled.
+
+    Each document uses the paths it would have with ``make()``, so that its
+    data, solutions, and attempt numbers are the same however it is built.
+    Documents whose data file, solution file, or assignment directory would
+    be the same (as for documents in the same directory with the default
+    ``randassigndir``) cannot be built together, and raise an error.
+
+    If a build fails (without ``keepgoing``), only the run for that document
+    is discarded; the other documents are completed, and then the error is
+    raised.
+    '''
+    start = time.time()
+    kwargs = dict(kwargs)
+    kwargs.pop('texfile', None)
+    kwargs.pop('manifest', None)
+    if kwargs.pop('argv', False):
+        for k, v in vars(argv_parser.parse_args()).items():
+            if v is not None and k not in ('texfile', 'manifest'):
+                kwargs[k] = v
+    for k in ('trace', 'cores'):
+        if kwargs.get(k) is not None:
+            raise RuntimeError('Option "{0}" is not supported when building several documents'.format(k))
+    for k in ('watch', 'serve', 'release'):
+        if kwargs.get(k):
+            raise RuntimeError('Option "{0}" is not supported when building several documents'.format(k))
+    # Builds always use private directories, since documents and students are
+    # built simultaneously
+    kwargs['isolate'] = True
+    kwargs['argv'] = False
+
+    args = [_process_args(dict(kwargs, texfile=texfile)) for texfile in texfiles]
+    _check_collisions(args)
+    a0 = args[0]
+
+    callbacks = []
+    if not a0.verbose and not a0.silent:
+        callbacks.append(TerminalProgress())
+    if a0.progress is not None:
+        callbacks.append(a0.progress)
+    progress = Progress(callbacks)
+    progress.phase('load')
+
+    runs = []
+    reports = []
+    try:
+        if a0.parsestudentfile is _parsestudentfile and a0.parsestudentname is _parsestudentname:
+            # The roster is cached with the first document's data
+            _check_directory_structure(a0.solndir)
+            rosterfile = _rosterfile(a0)
+        else:
+            rosterfile = None
+        students = _load_students(a0.student, a0.studentfile, a0.parsestudentfile, a0.parsestudentname, rosterfile)
+        for a in args:
+            run = _MakeRun(a)
+            run.progress = _DocumentProgress(progress, a.texfile.rsplit('.', 1)[0])
+            run.start(students)
+            runs.append(run)
+            report = MakeReport()
+            report.solnfile = a.solnfile
+            report.datafile = a.randassigndatafile
+            if run.sink is not None:
+                report.archive = run.sink.path
+            reports.append(report)
+    except:
+        for run in runs:
+            run.rollback()
+        progress.phase('done')
+        raise
+
+    try:
+        errors = _build(runs, reports, progress, a0.jobs)
+    finally:
+        progress.phase('done')
+    for a, report in zip(args, reports):
+        if report.failed:
+            report.retryfile = _write_retryfile(_retryfile(a), report.failed, a.silent)
+        report.elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    return reports
+
+
+def _check_collisions(args):
+    '''
+    Raise an error if any of the documents in ``args`` would share a data
+    file, a solution file, or a directory of assignments, since their runs
+    would then overwrite each other's files.
+    '''
+    paths = {}
+    for d, a in enumerate(args):
+        texfile = os.path.join(a.texdir, a.texfile)
+        shared = [('data file', a.randassigndatafile), ('solution file', a.solnfile)]
+        if a.assignsink == 'dir':
+            shared.append(('assignment directory', a.assigndir))
+        for kind, path in shared:
+            other, othertexfile = paths.setdefault((kind, os.path.normcase(path)), (d, texfile))
+            if other != d:
+                raise RuntimeError('The documents "{0}" and "{1}" would share the {2} "{3}"; build them separately, with different values of "randassigndir"'.format(othertexfile, texfile, kind, path))
+
+
+def _build(runs, reports, progress, jobs):
+    '''
+    Build all documents in ``runs`` with ``jobs`` workers, and complete each
+    run once its builds are done.  Return any errors, after discarding the
+    runs in which they occurred.
+    '''
+    lock = threading.Lock()
+    todo = collections.deque()
+    remaining = []
+    for d, run in enumerate(runs):
+        order = run.order() if not run.a.onlysolutions else []
+        todo.extend((d, n) for n in order)
+        remaining.append(len(order))
+    progress.phase('build', total=len(todo))
+    failed = [None]*len(runs)
+    errors = []
+
+    def done(d):
+        '''
+        Complete run ``d``, once all of its builds are done.
+        '''
+        run = runs[d]
+        if failed[d] is None:
+            try:
+                run.finish()
+                if run.bundle is not None and run.bundle.count:
+                    reports[d].bundle = run.bundle.pdffile
+                return
+            except Exception as e:
+                failed[d] = e
+        run.rollback()
+        with lock:
+            errors.append(failed[d])
+
+    def work():
+        # Each worker has its own build directory for each document, which is
+        # primed the first time the worker builds that document
+        slots = {}
+        while True:
+            # Builds for documents that have failed are skipped
+            skipped = []
+            with lock:
+                while todo and failed[todo[0][0]] is not None:
+                    d, _ = todo.popleft()
+                    remaining[d] -= 1
+                    if remaining[d] == 0:
+                        skipped.append(d)
+                task = todo.popleft() if todo else None
+            for d in skipped:
+                done(d)
+            if task is None:
+                return
+            d, n = task
+            run = runs[d]
+            try:
+                if d not in slots:
+                    builddir = _make_builddir(run.a.randassigndir, run.a.scratchdir)
+                    with run.lock:
+                        run.createddirs.append(builddir)
+                    slots[d] = _BuildSlot(run.a, builddir)
+                r = run.build_student(slots[d], n)
+                reports[d].results.append(r)
+            except Exception as e:
+                with lock:
+                    if failed[d] is None:
+                        failed[d] = e
+            with lock:
+                remaining[d] -= 1
+                last = remaining[d] == 0
+            if last:
+                done(d)
+
+    # Documents without builds, as with `onlysolutions`, are completed first
+    for d in range(len(runs)):
+        if remaining[d] == 0:
+            done(d)
+    threads = [threading.Thread(target=work) for _ in range(max(1, min(jobs, len(todo))))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
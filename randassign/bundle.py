@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015, Geoffrey M. Poore
+# All rights reserved.
+#
+# Licensed under the BSD 3-Clause License:
+# http://opensource.org/licenses/BSD-3-Clause
+#
+
+
+'''
+Print bundle combining all assignments from a run into a single PDF, for
+``make(bundle=True)``.
+'''
+
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+
+import os
+import sys
+if sys.version_info.major == 2:
+    from io import open
+import threading
+
+
+
+
+_bundletemplate_start = '''\
+\\documentclass[{options}]{{article}}
+\\usepackage{{pdfpages}}
+\\usepackage[bookmarks=true, bookmarksopen=false, pdfpagemode=UseOutlines]{{hyperref}}
+\\begin{{document}}
+'''
+
+_bundletemplate_entry = '''\
+\\includepdf[pages=-, addtotoc={{1, section, 1, {{{title}}}, randassign{number}}}]{{{file}}}
+'''
+
+_bundletemplate_end = '''\
+\\end{document}
+'''
+
+_tex_escapes = {'\\': '\\textbackslash{}', '{': '\\{', '}': '\\}',
+                '#': '\\#', '$': '\\$', '%': '\\%', '&': '\\&', '_': '\\_',
+                '^': '\\^{}', '~': '\\~{}'}
+
+
+def _tex_escape(s):
+    return ''.join(_tex_escapes.get(c, c) for c in s)
+
+
+
+
+class PrintBundle(object):
+    '''
+    LaTeX document that includes each assignment via ``pdfpages``, with a
+    bookmark for each student.  Assignments are completed in an order that
+    varies with simultaneous builds and scheduling, so only their file names
+    are held as they are added, and the entries are written in the order of
+    the student file when the bundle is closed.  LaTeX reads each assignment
+    only when it is included, so memory use does not depend on the number of
+    assignments.
+
+    With ``duplex``, each assignment starts on an odd page, so that no sheet
+    contains pages from two students when printed double-sided.
+    '''
+    def __init__(self, texfile, duplex=True):
+        self.texfile = os.path.abspath(texfile)
+        self.pdffile = self.texfile.rsplit('.', 1)[0] + '.pdf'
+        self.duplex = duplex
+        self.lock = threading.Lock()
+        self.count = 0
+        self.entries = []
+        self.f = None
+
+    def open(self):
+        self.f = open(self.texfile, 'w', encoding='utf8')
+        self.f.write(_bundletemplate_start.format(options='twoside' if self.duplex else 'oneside'))
+        self.f.flush()
+
+    def add(self, pdffile, title, index):
+        '''
+        Add the assignment ``pdffile``, bookmarked as ``title``, at position
+        ``index`` in the student file.
+        '''
+        # Forward slashes work under Windows as well, and avoid escaping
+        path = os.path.relpath(pdffile, os.path.dirname(self.texfile)).replace(os.sep, '/')
+        with self.lock:
+            self.count += 1
+            self.entries.append((index, path, title))
+
+    def close(self):
+        if self.f is not None:
+            self.entries.sort(key=lambda entry: entry[0])
+            for number, (_, path, title) in enumerate(self.entries, 1):
+                self.f.write(_bundletemplate_entry.format(title=_tex_escape(title), number=number, file=path))
+                if self.duplex:
+                    self.f.write('\\cleardoublepage\n')
+            self.f.write(_bundletemplate_end)
+            self.f.close()
+            self.f = None
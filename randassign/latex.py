@@ -19,6 +19,9 @@ import inspect
 import atexit
 import json
 import warnings
+import random
+import hashlib
+import threading
 if sys.version_info.major == 2:
     from io import open
     str = unicode
@@ -26,6 +29,28 @@ if sys.version_info.major == 2:
 
 
 
+# Instances whose solutions have not yet been saved.  A single exit handler
+# saves them all, rather than one handler per instance, so that a process
+# that creates many instances doesn't accumulate handlers, and instances that
+# have been cleaned up are released.
+_instances = []
+_instances_lock = threading.Lock()
+
+
+def _cleanup():
+    '''
+    Make sure all accumulated data is saved into message files before exit
+    '''
+    with _instances_lock:
+        instances = list(_instances)
+    for ra in instances:
+        ra.cleanup()
+
+atexit.register(_cleanup)
+
+
+
+
 class RandAssign(object):
     '''
     Manage the creation of solutions/keys for randomized assignments.
@@ -56,10 +81,20 @@ class RandAssign(object):
       linebreaks must be included explicitly as ``\n`` in the text that is
       appended to ``ra.soln``.  This method of creating solutions may not be
       mixed with ``ra.addsoln()``.
+
+    * When ``randassign.make()`` retries a failed build, creating the
+      ``RandAssign`` instance reseeds ``random`` with a fresh seed, which is
+      available as ``ra.seed`` (otherwise None).  Other generators are not
+      reseeded; for NumPy, use ``numpy.random.seed(ra.seed)`` after creating
+      the instance.  Seeding ``random`` again later replaces the fresh seed.
     '''
-    def __init__(self, msgdir='.', msgfile=None, msgid=None):
+    def __init__(self, msgdir=None, msgfile=None, msgid=None):
         # Where temp file containing solutions will be written; typically, the
-        # directory where the .tex files are located
+        # directory where the .tex files are located.  When ``randassign.make()``
+        # builds in a private directory, it supplies that directory via the
+        # environment.
+        if msgdir is None:
+            msgdir = os.environ.get('RANDASSIGN_MSGDIR', '.')
         self.msgdir = msgdir
 
         # Unique ID for solutions
@@ -84,19 +119,48 @@ class RandAssign(object):
 
         self.msgfilewithpath = os.path.expanduser(os.path.expandvars(os.path.join(self.msgdir, self.msgfile)))
 
+        # When a failed build is retried, ``randassign.make()`` supplies a
+        # fresh seed, so that a retry doesn't depend on how the random number
+        # generator was seeded (for example, based on the student's name).
+        # The seed is combined with the unique ID so that sessions differ, and
+        # reduced to an integer below 2**32 that other generators accept.
+        # Only ``random`` is reseeded, and only here; sessions that reseed
+        # ``random`` later, or that use other generators such as NumPy's,
+        # need to seed them with ``self.seed`` when it is not None.
+        self.seed = os.environ.get('RANDASSIGN_SEED')
+        if self.seed is not None:
+            h = hashlib.sha1('{0}:{1}'.format(self.seed, self.id).encode('utf8'))
+            self.seed = int(h.hexdigest()[:8], 16)
+            random.seed(self.seed)
+
+        # Student name and attempt for the assignment being built, supplied by
+        # ``randassign.make()``; None when compiling manually.  This allows
+        # sessions to use them without the name and attempt files, as with
+        # ``injection`` "cmdline".
+        self.name = os.environ.get('RANDASSIGN_NAME')
+        self.attempt = os.environ.get('RANDASSIGN_ATTEMPT')
+        if self.attempt is not None:
+            self.attempt = int(self.attempt)
+
+        # With ``selectiverun``, ``randassign.make()`` runs PythonTeX with
+        # ``--rerun modified`` and supplies a token file that changes for each
+        # assignment.  Making the session depend on it marks the session as
+        # randomized, so that it is rerun for each student, while sessions
+        # that don't use RandAssign are only executed once.
+        tokenfile = os.environ.get('RANDASSIGN_TOKENFILE')
+        if tokenfile is not None:
+            pytex = inspect.stack()[1][0].f_globals.get('pytex')
+            if pytex is None:
+                raise RuntimeError('RandAssign with "selectiverun" must be created in a PythonTeX session')
+            pytex.add_dependencies(tokenfile)
+
         self.soln = []
         self._addsoln_list = []
         self._number = 0
 
-        atexit.register(self._cleanup)
         self._iscleanedup = False
-
-    def _cleanup(self):
-        '''
-        Make sure all accumulated data is saved into message files before exit
-        '''
-        if not self._iscleanedup:
-            self.cleanup()
+        with _instances_lock:
+            _instances.append(self)
 
     def cleanup(self):
         '''
@@ -105,6 +169,20 @@ class RandAssign(object):
         if self._iscleanedup:
             warnings.warn('cleanup() has already been called')
             return
+        # The instance is finished whether or not it has solutions, or saving
+        # them fails, so it is always released
+        try:
+            self._save()
+        finally:
+            self._iscleanedup = True
+            with _instances_lock:
+                if self in _instances:
+                    _instances.remove(self)
+
+    def _save(self):
+        '''
+        Write accumulated solutions to the message file, if there are any
+        '''
         if not self.soln and not self._addsoln_list:
             return
         elif self.soln and self._addsoln_list:
@@ -125,8 +203,6 @@ class RandAssign(object):
             f.write(json.dumps(d, indent=2, ensure_ascii=False))
             f.write('\n')
 
-        self._iscleanedup = True
-
     def addsoln(self, *args, **kwargs):
         '''
         Add a solution.
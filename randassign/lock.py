@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015, Geoffrey M. Poore
+# All rights reserved.
+#
+# Licensed under the BSD 3-Clause License:
+# http://opensource.org/licenses/BSD-3-Clause
+#
+
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+
+import os
+import sys
+import time
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+
+
+# Locks are also tracked within the current process.  `flock()` locks belong
+# to open file descriptions, so they do serialize threads that each open the
+# lock file, but the Windows locking functions give no such guarantee.
+_process_locks = {}
+_process_locks_lock = threading.Lock()
+
+
+def _process_lock(path):
+    with _process_locks_lock:
+        try:
+            return _process_locks[path]
+        except KeyError:
+            lock = threading.Lock()
+            _process_locks[path] = lock
+            return lock
+
+
+
+
+class FileLock(object):
+    '''
+    Advisory, exclusive lock based on a lock file.
+
+    Usage::
+
+        with FileLock('<file>.lock'):
+            ...
+
+    The lock is held via ``flock()`` under POSIX systems and via
+    ``msvcrt.locking()`` under Windows, so it is released automatically if the
+    process holding it exits.  The lock file itself is left in place, since
+    removing it could allow two processes to lock different files with the
+    same name.
+
+    If the lock is held elsewhere, a message is printed (unless ``silent``)
+    and the lock is waited for.
+    '''
+    def __init__(self, path, silent=False, poll=0.1):
+        self.path = os.path.abspath(path)
+        self.silent = silent
+        self.poll = poll
+        self._fd = None
+        self._plock = _process_lock(self.path)
+
+    def acquire(self, blocking=True):
+        '''
+        Acquire the lock, waiting for it if ``blocking``.  Otherwise, return
+        False immediately if it is held elsewhere.
+        '''
+        if not self._plock.acquire(False):
+            if not blocking:
+                return False
+            self._wait_message()
+            self._plock.acquire()
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                locked = self._trylock(fd)
+                if not locked and blocking:
+                    self._wait_message()
+                    while not self._trylock(fd):
+                        time.sleep(self.poll)
+                    locked = True
+            except:
+                os.close(fd)
+                raise
+        except:
+            self._plock.release()
+            raise
+        if not locked:
+            os.close(fd)
+            self._plock.release()
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+            self._plock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def _trylock(self, fd):
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _wait_message(self):
+        if not self.silent:
+            print('Waiting for lock "{0}" held by another randassign run'.format(self.path), file=sys.stderr)
@@ -21,7 +21,6 @@ if sys.version_info.major == 2:
 import shlex
 import collections
 import shutil
-import atexit
 import json
 import zipfile
 try:
@@ -31,6 +30,27 @@ except ImportError:
 import argparse
 import subprocess
 import fnmatch
+import re
+import binascii
+import string
+import hashlib
+import tempfile
+import threading
+import errno
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from .lock import FileLock
+from .progress import Progress, TerminalProgress
+from .trace import Tracer, NullTracer
+from .sinks import sinks
+from .bundle import PrintBundle
 
 
 
@@ -48,16 +68,18 @@ import fnmatch
 # All values are None by default, so that `make()` can determine where values
 # came from.  The parsing makes no distinction between `make()` being invoked
 # in the `randassign` command-line utility and `make()` being used in a custom
-# script.  In both cases, `sys.argv` is used to supplement supplied arguments
-# as possible.  This may be turned off with `make(<kwargs>, argv=False)`.
+# script.  `main()` uses `sys.argv` to supplement supplied arguments, and a
+# custom script may do the same with `make(<kwargs>, argv=True)`.
 argv_parser = argparse.ArgumentParser()
 argv_parser.add_argument('--version', action='version', version=__version__)
 argv_parser.add_argument('--verbose', '-v', default=None, action='store_true',
                          help='Verbose output')
 argv_parser.add_argument('--silent', '-s', default=None, action='store_true',
                          help='Suppress all output')
-argv_parser.add_argument('texfile', nargs='?', default=None,
-                         help='Assignment file')
+argv_parser.add_argument('texfile', nargs='*', default=None,
+                         help='Assignment file(s); several files are built together, sharing a pool of --jobs builds')
+argv_parser.add_argument('--manifest', default=None,
+                         help='File listing assignment files to build together, one per line')
 argv_parser.add_argument('--texcmd', default=None,
                          help='Command for running LaTeX')
 argv_parser.add_argument('--pythontexcmd', default=None,
@@ -66,6 +88,112 @@ argv_parser.add_argument('--student', default=None,
                          help='Individual student for whom to generate assignment (name must also be in the student file; unique partial matches are accepted)')
 argv_parser.add_argument('--onlysolutions', default=None, action='store_true',
                          help='Only generate solutions; useful for regenerating solutions in a different format or with a new template')
+argv_parser.add_argument('--assignsink', default=None, choices=['dir', 'zip', 'tar'],
+                         help='Save assignments as files in the assignment directory ("dir"), or append them to a single archive ("zip" or "tar")')
+argv_parser.add_argument('--assignlayout', default=None, choices=['flat', 'letter', 'attempt', 'hash'],
+                         help='Layout of assignment files:  all in the assignment directory ("flat"), or in subdirectories by first letter, attempt, or hash prefix')
+argv_parser.add_argument('--bundle', default=None, action='store_true',
+                         help='Combine the assignments from the run into a single PDF for printing, with a bookmark for each student')
+argv_parser.add_argument('--jobs', '-j', default=None, type=int,
+                         help='Number of students for whom to build assignments simultaneously (implies --isolate when greater than 1)')
+argv_parser.add_argument('--cores', default=None, type=int,
+                         help='Total number of cores to use, divided between simultaneous builds and PythonTeX jobs (replaces --jobs)')
+argv_parser.add_argument('--injection', default=None, choices=['file', 'cmdline'],
+                         help='Pass the student name and attempt to LaTeX by writing the name and attempt files ("file"), or as macros on the command line ("cmdline"), so that simultaneous builds can share the document directory')
+argv_parser.add_argument('--selectiverun', default=None, action='store_true',
+                         help='Only rerun the PythonTeX sessions that use RandAssign for each student, and reuse the output of the others')
+argv_parser.add_argument('--maxtexpasses', default=None, type=int,
+                         help='Maximum number of final LaTeX runs for each assignment, which are repeated until cross-references settle (default 4)')
+argv_parser.add_argument('--keepgoing', '-k', default=None, action='store_true',
+                         help='Keep going when the assignment for a student fails, keeping all successful assignments and saving a list of failed students for retrying')
+argv_parser.add_argument('--retries', default=None, type=int,
+                         help='Number of times to retry a failed assignment, with a fresh random seed')
+argv_parser.add_argument('--schedule', default=None, choices=['adaptive', 'roster'],
+                         help='Order in which to build students:  previously failed and slowest first ("adaptive"), or as in the student file ("roster")')
+argv_parser.add_argument('--trace', default=None,
+                         help='Save a timeline of the run in Chrome trace-event format')
+argv_parser.add_argument('--scratchdir', default=None,
+                         help='Directory in which to build assignments, such as a memory-backed file system (implies --isolate)')
+argv_parser.add_argument('--watch', default=None, action='store_true',
+                         help='Keep running, and rebuild preview assignments whenever the tex file or its inputs change')
+argv_parser.add_argument('--preview', default=None, type=int,
+                         help='Number of students from the start of the student file for whom to build preview assignments under --watch')
+argv_parser.add_argument('--prebuildattempts', default=None, type=int,
+                         help='Build this many future attempts for each student, and keep them until they are released')
+argv_parser.add_argument('--release', default=None, action='store_true',
+                         help='Release the next prebuilt attempt for --student, or for all students with prebuilt attempts')
+argv_parser.add_argument('--serve', default=None, action='store_true',
+                         help='Keep running as a local HTTP service that builds a new attempt for a single student on request')
+argv_parser.add_argument('--serveport', default=None, type=int,
+                         help='Port for --serve (default 8000)')
+argv_parser.add_argument('--isolate', default=None, action='store_true',
+                         help='Build assignments in a private directory, so that runs for different students may proceed simultaneously')
+
+
+
+# Result of building the assignment for a single student
+#
+# `student` is the name as it appears on the assignment, and `student_raw` is
+# the raw name from the student file, which is used as the key in the data
+# file.  `attempt` is None when `multipleattempts` is False.  `assignment` is
+# the path to the assignment, or the name of its entry in the archive with
+# `assignsink` "zip" or "tar", and `solutions` is the list of solutions for
+# the attempt, as saved in the data file.  `timings` maps "tex",
+# "pythontex", and "total" to times in seconds, plus "prime" for the initial
+# tex run that is needed before the first build in a directory.  `error` is None for
+# successful builds.  `log` is the log file with the output of all commands.
+StudentResult = collections.namedtuple('StudentResult',
+                                       ['student', 'student_raw', 'attempt',
+                                        'assignment', 'solutions', 'timings',
+                                        'error', 'log'])
+
+
+
+
+class MakeReport(object):
+    '''
+    Summary of a run of ``make()``.
+
+    Attributes:
+        results:  List of ``StudentResult`` for all students, in the order
+                  in which they were completed; with ``keepgoing``, this
+                  includes failed students
+        solnfile:  Solution file
+        datafile:  Data file
+        archive:  Archive containing the assignments, or None if
+                  ``assignsink`` is "dir"
+        bundle:  Print bundle of the assignments, or None
+        retryfile:  Student file listing the failed students, or None if
+                    there were no failures
+        elapsed:  Total time for the run, in seconds
+    '''
+    def __init__(self):
+        self.results = []
+        self.solnfile = None
+        self.datafile = None
+        self.archive = None
+        self.bundle = None
+        self.retryfile = None
+        self.elapsed = None
+
+    @property
+    def assignments(self):
+        '''
+        Paths to the assignments that were created, or their entries in the
+        archive.
+        '''
+        return [r.assignment for r in self.results if r.error is None]
+
+    @property
+    def failed(self):
+        '''
+        Results for students whose assignments failed.
+        '''
+        return [r for r in self.results if r.error is not None]
+
+    def __repr__(self):
+        return 'MakeReport(assignments={0}, failed={1}, solnfile={2!r}, elapsed={3:.1f})'.format(len(self.assignments), len(self.failed), self.solnfile, self.elapsed or 0)
+
 
 
 
@@ -87,69 +215,284 @@ def make(**kwargs):
     typical customization should be able to be accomplished by passing
     arguments to ``make()``.
 
-    By default, ``make()`` checks ``sys.argv`` for arguments, regardless of
-    how it is invoked.  This is needed for the command-line ``randassign``,
-    and is also useful for running scripts with one-time values.  This behavior
-    may be disabled via ``make(<kwargs>, argv=False)``.  Note that only a
-    subset of the arguments of ``make()`` are supported via the command line;
-    run ``randassing --help`` for a list of supported arguments.
+    With ``make(<kwargs>, argv=True)``, arguments from ``sys.argv``
+    supplement (and override) those that are passed.  This is how the
+    command-line ``randassign`` works, and is also useful for running scripts
+    with one-time values.  Note that only a subset of the arguments of
+    ``make()`` are supported via the command line; run ``randassign --help``
+    for a list of supported arguments.
+
+    ``make()`` does not change the working directory or register exit
+    handlers, so it may be called repeatedly in a long-running process, and
+    runs for different documents may proceed simultaneously in separate
+    threads.  Relative paths are resolved against the document directory,
+    except for ``studentfile`` and ``trace``, which are resolved against the
+    working directory.
+
+    Returns a ``MakeReport`` summarizing the run.  Use ``iter_make()`` to
+    receive the result for each student as soon as it is available.
+
+    If ``texfile`` is a list of LaTeX files, or ``manifest`` is a file
+    listing them, then the documents are built together, sharing a pool of
+    ``jobs`` builds, and a list with a ``MakeReport`` for each document is
+    returned.  See ``randassign.batch``.
+    '''
+    texfiles = _batch_texfiles(kwargs)
+    if texfiles is not None:
+        from .batch import make_batch
+        return make_batch(texfiles, kwargs)
+
+    report = MakeReport()
+    for _ in _iter_make(kwargs, report):
+        pass
+    return report
+
+
+
+
+def iter_make(**kwargs):
+    '''
+    Generate randomized assignments and solutions, yielding a
+    ``StudentResult`` as each student's assignment is completed::
+
+        from randassign import iter_make
+        for result in iter_make(texfile='<tex_file>'):
+            print(result.student, result.assignment)
+
+    Accepts the same keyword arguments as ``make()``.  The data file and
+    solutions are updated after the last result has been yielded.  If an
+    error occurs, or if the generator is closed before all results have been
+    yielded, everything created during the run is discarded, as with
+    ``make()``.
     '''
+    return _iter_make(kwargs, MakeReport())
 
+
+
+
+def _iter_make(kwargs, report):
+    '''
+    Run ``make()``, yielding results as they are available and completing
+    ``report`` at the end.
+    '''
+    start = time.time()
     a = _process_args(kwargs)
-    # Need to do everything while in the same directory as the .tex file
-    # This ensures that all output stays with the .tex file, or in subdirectories
-    orig_workingdir = os.getcwd()
-    if a.texdir:
-        os.chdir(a.texdir)
-
-    # Need a way to clean up created files in the event of an error
-    createdfiles = []
-    def cleanup():
-        for f in createdfiles:
-            try:
-                os.remove(f)
-            except:
-                pass
-    atexit.register(cleanup)
+    if a.watch:
+        raise RuntimeError('Option "watch" is only supported by watch() and the command-line utility')
+    if a.serve:
+        raise RuntimeError('Option "serve" is only supported by serve() and the command-line utility')
+    if a.release:
+        raise RuntimeError('Option "release" is only supported by release() and the command-line utility')
+    run = _MakeRun(a)
+    report.solnfile = a.solnfile
+    report.datafile = a.randassigndatafile
+    retryfile = _retryfile(a)
+    # Anything created by the run is discarded if it fails or is interrupted,
+    # before this call returns
+    try:
+        run.start()
+        if run.sink is not None:
+            report.archive = run.sink.path
+        if not a.onlysolutions:
+            for r in run.iterbuild():
+                report.results.append(r)
+                yield r
+        run.finish()
+        if run.bundle is not None and run.bundle.count:
+            report.bundle = run.bundle.pdffile
+    except:
+        run.rollback()
+        raise
+    if report.failed:
+        report.retryfile = _write_retryfile(retryfile, report.failed, a.silent)
+    report.elapsed = time.time() - start
+
+
+
+
+def release(**kwargs):
+    '''
+    Hand out the next prebuilt attempt (see ``prebuildattempts``) for
+    ``student``, or for every student in the student file who has prebuilt
+    attempts::
+
+        from randassign import release
+        release(texfile='<tex_file>', student='<student>')
+
+    Accepts the same keyword arguments as ``make()``.  Each released
+    assignment is moved from ``<randassigndir>/reserved`` into ``assigndir``,
+    and its solutions are added to those of the student's issued attempts.
+    The data file is saved before the solutions are written, so that the
+    assignments are available as quickly as possible.
+
+    Returns a ``MakeReport``, with a ``StudentResult`` for each released
+    assignment.
+    '''
+    start = time.time()
+    a = _process_args(kwargs)
+    report = MakeReport()
+    report.solnfile = a.solnfile
+    report.datafile = a.randassigndatafile
+    if a.parsestudentfile is _parsestudentfile and a.parsestudentname is _parsestudentname:
+        rosterfile = _rosterfile(a)
+    else:
+        rosterfile = None
+    s = _load_students(a.student, a.studentfile, a.parsestudentfile, a.parsestudentname, rosterfile)
+    datalock = FileLock(a.randassigndatafile + '.lock', silent=a.silent)
+    with datalock:
+        data = _load_data(a.randassigndatafile, a.randassigndatafilefmt)
+        moved = []
+        try:
+            for student, student_raw_str in zip(s[0], s[2]):
+                record = data.get(student_raw_str)
+                if not record or not record.get('reserved'):
+                    if a.student is not None:
+                        raise RuntimeError('There are no prebuilt attempts for {0}'.format(student))
+                    continue
+                entry = record['reserved'][0]
+                if entry['attempt'] != len(record['solutions']) + 1:
+                    raise RuntimeError('The next prebuilt attempt for {0} is attempt {1}, but attempt {2} was expected'.format(student, entry['attempt'], len(record['solutions']) + 1))
+                oldfile = os.path.abspath(os.path.join(_reserveddir(a), *entry['assignment'].split('/')))
+                name = _assignname(student_raw_str, entry['attempt'], a.assignlayout)
+                newfile = os.path.abspath(os.path.join(a.assigndir, *name.split('/')))
+                if os.path.isfile(newfile):
+                    raise RuntimeError('The assignment "{0}" already exists'.format(newfile))
+                if not os.path.isdir(os.path.dirname(newfile)):
+                    os.makedirs(os.path.dirname(newfile))
+                shutil.move(oldfile, newfile)
+                moved.append((oldfile, newfile))
+                del record['reserved'][0]
+                record['solutions'].append(entry['solutions'])
+                report.results.append(StudentResult(student, student_raw_str, entry['attempt'], newfile,
+                                                    entry['solutions'], {}, None, None))
+            _save_data(data, a.randassigndatafile, a.randassigndatafilefmt)
+        except:
+            # Put the assignments back, since the data was not saved
+            for oldfile, newfile in reversed(moved):
+                shutil.move(newfile, oldfile)
+            raise
+        for r in report.results:
+            if not a.silent:
+                print('Released attempt {0} for {1}:  {2}'.format(r.attempt, r.student, r.assignment))
+        if report.results:
+            run = _MakeRun(a)
+            run.data = data
+            run.writesoln(a.solncmd)
+    report.elapsed = time.time() - start
+    return report
+
+
+
+
+def main():
+    '''
+    Entry point for the command-line utility ``randassign``.  The exit status
+    is nonzero if any assignments failed under ``--keepgoing``.
+    '''
+    args = argv_parser.parse_args()
+    if args.watch:
+        from .watch import watch
+        watch(argv=True)
+        return 0
+    if args.serve:
+        from .server import serve
+        serve(argv=True)
+        return 0
+    if args.release:
+        release(argv=True)
+        return 0
+    report = make(argv=True)
+    if isinstance(report, list):
+        return 1 if any(r.failed for r in report) else 0
+    return 1 if report.failed else 0
+
+
+
+
+def _batch_texfiles(kwargs):
+    '''
+    Return the list of LaTeX files to build together, if ``make()`` was
+    given several via ``texfile`` (or the command line) or via ``manifest``,
+    and otherwise None.
+    '''
+    texfile = kwargs.get('texfile')
+    manifest = kwargs.get('manifest')
+    if kwargs.get('argv', False):
+        args = argv_parser.parse_args()
+        if args.texfile:
+            texfile = args.texfile[0] if len(args.texfile) == 1 else args.texfile
+        if args.manifest is not None:
+            manifest = args.manifest
+    if manifest is not None:
+        if texfile is not None:
+            raise RuntimeError('Cannot use options "texfile" and "manifest" simultaneously')
+        return _read_manifest(manifest)
+    if isinstance(texfile, list):
+        return texfile
+    return None
+
+
+def _read_manifest(manifest):
+    '''
+    Read a manifest of LaTeX files, one per line, relative to the manifest's
+    directory.  Blank lines and lines starting with ``#`` are ignored.
+    '''
+    manifest = os.path.expanduser(os.path.expandvars(manifest))
+    if not os.path.isfile(manifest):
+        raise RuntimeError('Could not find manifest "{0}"'.format(manifest))
+    texfiles = []
+    with open(manifest, encoding='utf8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                texfiles.append(os.path.join(os.path.dirname(manifest), os.path.expanduser(os.path.expandvars(line))))
+    if not texfiles:
+        raise RuntimeError('The manifest "{0}" does not list any tex files'.format(manifest))
+    return texfiles
+
+
 
-    _check_directory_structure(a.randassigndir, a.solndir, a.assigndir)
 
-    data = _load_data(a.randassigndatafile, a.randassigndatafilefmt)
+def _archivefile(a):
+    '''
+    Archive to which assignments are appended, with ``assignsink`` "zip" or
+    "tar".
+    '''
+    return os.path.join(a.assigndir, '{0}.{1}'.format(a.texfile.rsplit('.', 1)[0], a.assignsink))
+
+
+def _bundledir(a):
+    '''
+    Directory for the print bundle.
+    '''
+    return os.path.join(a.randassigndir, 'bundle')
 
-    s = _load_students(a.student, a.studentfile, a.parsestudentfile, a.parsestudentname)
-    students, students_raw, students_raw_str = s
 
-    if not a.onlysolutions:
-        _run(data, createdfiles, students, students_raw, students_raw_str,
-             a.verbose, a.silent, a.texcmd, a.texfile, a.namefile, a.attemptfile,
-             a.pythontexcmd, a.msgfilepattern, a.assigndir, a.multipleattempts)
+def _reserveddir(a):
+    '''
+    Directory for prebuilt attempts that have not yet been released.
+    '''
+    return os.path.join(a.randassigndir, 'reserved')
+
 
-    # The default `writesoln()` requires all arguments to function correctly,
-    # but is written so that all arguments but `data` are keyword arguments.
-    # This makes it simple to write custom functions of the form
-    # `custom_writesoln(data, **kwargs)`, which can ignore any keyword args
-    # that aren't actually used.
-    a.writesoln(data, verbose=a.verbose, silent=a.silent,
-                solncmd=a.solncmd, solnfile=a.solnfile, solnfmt=a.solnfmt,
-                onlylastsoln=a.onlylastsoln,
-                multipleattempts=a.multipleattempts,
-                solntemplatedoc=a.solntemplatedoc,
-                solntemplatestudent=a.solntemplatestudent,
-                solntemplatesolnsattempt=a.solntemplatesolnsattempt,
-                solntemplatesolnswrapper=a.solntemplatesolnswrapper,
-                solntemplatesolnsingle=a.solntemplatesolnsingle,
-                solntemplatesolnsingleinfo=a.solntemplatesolnsingleinfo,
-                solntemplatesolnmultiwrapper=a.solntemplatesolnmultiwrapper,
-                solntemplatesolnmultiwrapperinfo=a.solntemplatesolnmultiwrapperinfo,
-                solntemplatesolnmulti=a.solntemplatesolnmulti,
-                createdfiles=createdfiles)
+def _retryfile(a):
+    '''
+    Student file listing the students whose assignments failed.
+    '''
+    return os.path.join(a.randassigndir, '{0}.retry.txt'.format(a.texfile.rsplit('.', 1)[0]))
 
-    _save_data(data, a.randassigndatafile, a.randassigndatafilefmt)
 
-    # Clear list of created files to keep them, since no errors occurred
-    # Using `atexit.unregister(cleanup)` would be cleaner, but Python 2.7
-    createdfiles[:] = []
-    os.chdir(orig_workingdir)
+def _write_retryfile(retryfile, failed, silent):
+    '''
+    Save the raw names of failed students in a file that may be used as the
+    student file for retrying them.  Return the file name.
+    '''
+    with open(retryfile, 'w', encoding='utf8') as f:
+        for r in failed:
+            f.write('{0}\n'.format(r.student_raw))
+    if not silent:
+        print('Failed to generate {0} assignment(s); to retry, use studentfile="{1}"'.format(len(failed), retryfile), file=sys.stderr)
+    return retryfile
 
 
 
@@ -166,6 +509,9 @@ def _process_args(kwargs):
         verbose:  Verbose output
         silent:  Suppress all output
         texfile:  LaTeX file from which to generate assignments
+        manifest:  File listing LaTeX files from which to generate
+                   assignments together, one per line; only supported by
+                   ``make()``
         texcmd:  Command for compiling LaTeX file (does not include file name)
         pythontexcmd:  Command for running PythonTeX (does not include file name)
         randassigndir:  Root directory for saving created assignments and
@@ -173,6 +519,18 @@ def _process_args(kwargs):
         subdirs:  Whether to create subdirectories under ``randassigndir`` for
                   assignments and solutions
         assigndir:  Subdirectory for assignments
+        assignsink:  How assignments are saved:  "dir" for individual files in
+                     ``assigndir``, or "zip" or "tar" for appending them to
+                     an archive in ``assigndir``
+        assignlayout:  Subdirectories of ``assigndir`` for assignments:  "flat"
+                       for none, "letter" by first letter of the name,
+                       "attempt" by attempt, "hash" by hash prefix, or a
+                       function that takes the raw student name and attempt
+                       and returns a subdirectory (for example, a section)
+        bundle:  Combine the assignments created during the run into a single
+                 PDF for printing, with a bookmark for each student
+        bundleduplex:  Start each assignment in the bundle on an odd page, for
+                       double-sided printing
         solndir:  Subdirectory for solutions
         namefile:  LaTeX file containing the name of the current student
         attemptfile:  LaTeX file containing the number of the current attempt
@@ -184,6 +542,58 @@ def _process_args(kwargs):
         parsestudentname:  Function for parsing individual lines of the student
                            file into student names in the desired format
         onlysolutions:  Only generate solutions; do not generate any assignments
+        primecache:  Save the files created by the initial LaTeX run, and reuse
+                     them in later runs while the document and its local
+                     inputs are unchanged, skipping that run
+        preflight:  Check the commands, the data, and the assignment file
+                    names for all students before building any assignments
+        prebuildattempts:  Number of future attempts to build for each student;
+                           these are saved in ``<randassigndir>/reserved``
+                           until they are handed out with ``release()``
+        release:  Used by the command-line utility to run ``release()``
+        watch:  Used by the command-line utility to run ``watch()``
+        preview:  Number of students for whom to build preview assignments
+                  under ``watch()``, from the start of the student file
+        serve:  Used by the command-line utility to run ``serve()``
+        servehost:  Address on which ``serve()`` listens
+        serveport:  Port on which ``serve()`` listens
+        isolate:  Build assignments in a private directory under
+                  ``randassigndir`` rather than in the document directory, so
+                  that simultaneous runs do not need to wait on each other
+        scratchdir:  Directory in which to create private build directories,
+                     instead of ``randassigndir``; implies ``isolate``
+        progress:  Function that is called with a ``ProgressSnapshot`` whenever
+                   the progress of the run changes
+        trace:  File in which to save a timeline of the run, in Chrome
+                trace-event format
+        jobs:  Number of students for whom to build assignments simultaneously;
+               values greater than 1 imply ``isolate``
+        cores:  Total number of cores to use; divided between simultaneous
+                builds and the ``--jobs`` option of PythonTeX, based on the
+                number of students and of PythonTeX sessions (replaces
+                ``jobs``)
+        injection:  How the student name and attempt are passed to LaTeX:
+                    "file" writes ``namefile`` and ``attemptfile``, while
+                    "cmdline" defines ``\\randassignname`` and
+                    ``\\randassignattempt`` on the LaTeX command line, with a
+                    separate job name for each simultaneous build, so that
+                    builds need no private directories
+        selectiverun:  Only rerun the PythonTeX sessions that use ``RandAssign``
+                       for each student (``--rerun modified``); the output of
+                       all other sessions is reused from the first build
+        autorerun:  Run LaTeX again after the final run as long as it changes
+                    the auxiliary files, so that cross-references and page
+                    breaks settle
+        maxtexpasses:  Maximum number of final LaTeX runs with ``autorerun``
+        keepgoing:  Keep going when the assignment for a student fails; keep
+                    all successful assignments, and save a list of failed
+                    students
+        retries:  Number of times to retry a failed assignment, with a fresh
+                  random seed
+        schedule:  Order in which to build students:  "adaptive" builds
+                   previously failed students first and then the students
+                   with the longest recorded build times, while "roster"
+                   follows the student file
         solnfile:  Solution file
         solnfmt:  Solution file format
         solncmd:  Command for post-processing solution file
@@ -218,17 +628,24 @@ def _process_args(kwargs):
     '''
 
     # Default keyword args
-    dkwargs = {'argv': True,
+    dkwargs = {'argv': False,
                'verbose': False,
                'silent': False,
-               'texfile': None, 'texcmd': 'pdflatex -interaction=nonstopmode',
+               'texfile': None, 'manifest': None, 'texcmd': 'pdflatex -interaction=nonstopmode',
                'pythontexcmd': 'pythontex --rerun always',
                'randassigndir': 'randassign',
                'subdirs': True, 'assigndir': 'assignments', 'solndir': 'solutions',
-               'namefile': 'name.tex', 'attemptfile': 'attempt.tex',
+               'assignsink': 'dir', 'assignlayout': 'flat',
+               'bundle': False, 'bundleduplex': True,
+               'namefile': 'name.tex', 'attemptfile': 'attempt.tex', 'injection': 'file',
                'student': None, 'studentfile': 'students.txt',
                'parsestudentfile': _parsestudentfile, 'parsestudentname': _parsestudentname,
-               'onlysolutions': False,
+               'onlysolutions': False, 'primecache': True, 'preflight': True, 'prebuildattempts': 0, 'release': False,
+               'watch': False, 'preview': 1,
+               'serve': False, 'servehost': '127.0.0.1', 'serveport': 8000,
+               'isolate': False, 'scratchdir': None, 'jobs': 1, 'cores': None, 'progress': None, 'trace': None,
+               'selectiverun': False, 'autorerun': True, 'maxtexpasses': 4,
+               'keepgoing': False, 'retries': 0, 'schedule': 'adaptive',
                'solnfile': None, 'solnfmt': 'tex', 'solncmd': 'pdflatex -interaction=nonstopmode',
                'writesoln': _writesoln,
                'msgfilepattern': '_randassign.*.json', 'onlylastsoln': False,
@@ -250,8 +667,11 @@ def _process_args(kwargs):
 
     # Update the final args with the kwargs from `make()`
     # Perform some basic type checking in processing kwargs
-    bools = ('argv', 'subdirs', 'onlylastsoln', 'multipleattempts', 'verbose', 'silent', 'onlysolutions')
-    funcs = ('parsestudentfile', 'parsestudentname', 'writesoln')
+    bools = ('argv', 'subdirs', 'onlylastsoln', 'multipleattempts', 'verbose', 'silent', 'onlysolutions', 'isolate', 'keepgoing', 'bundle', 'bundleduplex', 'selectiverun', 'autorerun', 'primecache', 'preflight', 'release', 'watch', 'serve')
+    funcs = ('parsestudentfile', 'parsestudentname', 'writesoln', 'progress')
+    ints = ('jobs', 'cores', 'maxtexpasses', 'retries', 'prebuildattempts', 'preview', 'serveport')
+    # May be a function or a string
+    strfuncs = ('assignlayout',)
     for k in kwargs:
         if k in dkwargs:
             v = kwargs[k]
@@ -261,7 +681,11 @@ def _process_args(kwargs):
                 pass
             elif k in funcs and hasattr(v, '__call__'):
                 pass
-            elif k not in bools+funcs and isinstance(v, str):
+            elif k in strfuncs and hasattr(v, '__call__'):
+                pass
+            elif k in ints and isinstance(v, int) and not isinstance(v, bool):
+                pass
+            elif k not in bools+funcs+ints and isinstance(v, str):
                 pass
             elif isinstance(v, bytes) and sys.version_info.major == 2:
                 v = str(v)
@@ -271,9 +695,9 @@ def _process_args(kwargs):
                 elif all(isinstance(x, bytes) and sys.version_info.major == 2 for x in v):
                     v = [str(x) for x in v]
                 else:
-                    raise TypeError('Invalid type {0} for keyword argument "{0}" supplied to make()'.format(v.__type__, k))
+                    raise TypeError('Invalid type {0} for keyword argument "{1}" supplied to make()'.format(type(v), k))
             else:
-                raise TypeError('Invalid type {0} for keyword argument "{0}" supplied to make()'.format(v.__type__, k))
+                raise TypeError('Invalid type {0} for keyword argument "{1}" supplied to make()'.format(type(v), k))
             fkwargs[k] = v
         else:
             raise KeyError('Invalid keyword argument "{0}" supplied to make()'.format(k))
@@ -284,6 +708,10 @@ def _process_args(kwargs):
     # the parser
     if fkwargs['argv'] is True:
         kwargv = {k:v for k, v in vars(argv_parser.parse_args()).items() if v is not None}
+        if kwargv['texfile']:
+            kwargv['texfile'] = kwargv['texfile'][0] if len(kwargv['texfile']) == 1 else kwargv['texfile']
+        else:
+            del kwargv['texfile']
         for k in kwargv:
             if k in dkwargs:
                 fkwargs[k] = kwargv[k]
@@ -292,8 +720,53 @@ def _process_args(kwargs):
 
 
     # Check arg compatibility
+    if fkwargs['manifest'] is not None or isinstance(fkwargs['texfile'], list):
+        raise RuntimeError('Multiple tex files and "manifest" are only supported by make()')
     if fkwargs['verbose'] and fkwargs['silent']:
         raise RuntimeError('Cannot use options "verbose" and "silent" simultaneously')
+    if fkwargs['injection'] not in ('file', 'cmdline'):
+        raise ValueError('Option "injection" must be "file" or "cmdline"; currently "{0}"'.format(fkwargs['injection']))
+    if fkwargs['jobs'] < 1:
+        raise ValueError('Option "jobs" must be at least 1; currently {0}'.format(fkwargs['jobs']))
+    elif fkwargs['jobs'] > 1 and fkwargs['injection'] == 'file':
+        # Simultaneous builds each need their own name and attempt files
+        fkwargs['isolate'] = True
+    if fkwargs['cores'] is not None:
+        if fkwargs['cores'] < 1:
+            raise ValueError('Option "cores" must be at least 1; currently {0}'.format(fkwargs['cores']))
+        if fkwargs['jobs'] > 1:
+            raise RuntimeError('Cannot use options "cores" and "jobs" simultaneously; "cores" determines the number of simultaneous builds')
+        if fkwargs['cores'] > 1 and fkwargs['injection'] == 'file':
+            fkwargs['isolate'] = True
+    if fkwargs['assignsink'] not in ('dir', 'zip', 'tar'):
+        raise ValueError('Option "assignsink" must be one of "dir", "zip", or "tar"; currently "{0}"'.format(fkwargs['assignsink']))
+    if fkwargs['bundle'] and fkwargs['assignsink'] != 'dir':
+        raise RuntimeError('Option "bundle" requires "assignsink" to be "dir"')
+    if not hasattr(fkwargs['assignlayout'], '__call__') and fkwargs['assignlayout'] not in _assignlayouts:
+        raise ValueError('Option "assignlayout" must be a function or one of "flat", "letter", "attempt", or "hash"; currently "{0}"'.format(fkwargs['assignlayout']))
+    if fkwargs['scratchdir'] is not None:
+        fkwargs['isolate'] = True
+    if fkwargs['preview'] < 1:
+        raise ValueError('Option "preview" must be at least 1; currently {0}'.format(fkwargs['preview']))
+    if fkwargs['prebuildattempts'] < 0:
+        raise ValueError('Option "prebuildattempts" must be non-negative; currently {0}'.format(fkwargs['prebuildattempts']))
+    if fkwargs['prebuildattempts'] or fkwargs['release']:
+        # Prebuilt attempts are numbered, and are moved into place when
+        # released
+        if not fkwargs['multipleattempts']:
+            raise RuntimeError('Options "prebuildattempts" and "release" require "multipleattempts"')
+        if fkwargs['assignsink'] != 'dir':
+            raise RuntimeError('Options "prebuildattempts" and "release" require "assignsink" to be "dir"')
+    if fkwargs['prebuildattempts'] and fkwargs['bundle']:
+        raise RuntimeError('Cannot use options "prebuildattempts" and "bundle" simultaneously')
+    if fkwargs['watch'] and fkwargs['serve']:
+        raise RuntimeError('Cannot use options "watch" and "serve" simultaneously')
+    if fkwargs['maxtexpasses'] < 1:
+        raise ValueError('Option "maxtexpasses" must be at least 1; currently {0}'.format(fkwargs['maxtexpasses']))
+    if fkwargs['retries'] < 0:
+        raise ValueError('Option "retries" must be non-negative; currently {0}'.format(fkwargs['retries']))
+    if fkwargs['schedule'] not in ('adaptive', 'roster'):
+        raise ValueError('Option "schedule" must be one of "adaptive" or "roster"; currently "{0}"'.format(fkwargs['schedule']))
 
     # Check texfile existence and extension after expanding
     # Then split off any path into texdir
@@ -305,7 +778,7 @@ def _process_args(kwargs):
         raise RuntimeError('The tex file "{0}" does not exist'.format(fkwargs['texfile']))
     if not texfile.endswith('.tex'):
         raise RuntimeError('The format of the tex file "{0}" appears to be invalid; lacks the extension .tex'.format(fkwargs['texfile']))
-    fkwargs['texdir'], fkwargs['texfile'] = os.path.split(texfile)
+    fkwargs['texdir'], fkwargs['texfile'] = os.path.split(os.path.abspath(texfile))
 
     # Format texcmd for subprocess
     if isinstance(fkwargs['texcmd'], str):
@@ -321,9 +794,15 @@ def _process_args(kwargs):
     elif isinstance(fkwargs['pythontexcmd'], list):
         fkwargs['pythontexcmd'] = fkwargs['pythontexcmd'] + [fkwargs['texfile']]
     fkwargs['pythontexcmd'][0] = os.path.expanduser(os.path.expandvars(fkwargs['pythontexcmd'][0]))
+    if fkwargs['selectiverun']:
+        fkwargs['pythontexcmd'] = _set_pythontex_rerun(fkwargs['pythontexcmd'], 'modified')
 
     # Set paths for randassign
-    fkwargs['randassigndir'] = os.path.expanduser(os.path.expandvars(fkwargs['randassigndir']))
+    # All paths are resolved against the document directory (or the working
+    # directory, for files given on the command line), so that a run never
+    # needs to change the working directory; commands are run in the
+    # directory they need instead
+    fkwargs['randassigndir'] = os.path.join(fkwargs['texdir'], os.path.expanduser(os.path.expandvars(fkwargs['randassigndir'])))
     # Set assigndir and solndir so that they are correct regardless of subdirs
     if fkwargs['subdirs']:
         fkwargs['assigndir'] = os.path.join(fkwargs['randassigndir'], os.path.expanduser(os.path.expandvars(fkwargs['assigndir'])))
@@ -336,9 +815,15 @@ def _process_args(kwargs):
     # Typically, these should be in the texdir, so this should be unnecessary
     for k in ('namefile', 'attemptfile'):
         fkwargs[k] = os.path.expanduser(os.path.expandvars(fkwargs[k]))
+        # Private build directories get their own copies of these files, which
+        # LaTeX finds before those in the document directory
+        if fkwargs['isolate'] and fkwargs['injection'] == 'file' and os.path.isabs(fkwargs[k]):
+            raise ValueError('Option "isolate" requires a relative path for "{0}"; currently "{1}"'.format(k, fkwargs[k]))
 
     # Set studentfile, assuming relative paths to workingdir
-    fkwargs['studentfile'] = os.path.expanduser(os.path.expandvars(fkwargs['studentfile']))
+    fkwargs['studentfile'] = os.path.abspath(os.path.expanduser(os.path.expandvars(fkwargs['studentfile'])))
+    if fkwargs['trace'] is not None:
+        fkwargs['trace'] = os.path.abspath(os.path.expanduser(os.path.expandvars(fkwargs['trace'])))
     if not os.path.isfile(fkwargs['studentfile']):
         raise RuntimeError('Could not find student file "{0}"'.format(fkwargs['studentfile']))
 
@@ -377,6 +862,8 @@ def _process_args(kwargs):
         fkwargs['randassigndatafile'] = os.path.join(fkwargs['solndir'], '{0}.{1}'.format(fkwargs['texfile'].rsplit('.', 1)[0], fkwargs['randassigndatafilefmt']))
     else:
         fkwargs['randassigndatafile'] = os.path.join(fkwargs['solndir'], os.path.expanduser(os.path.expandvars(fkwargs['randassigndatafile'])))
+    if fkwargs['scratchdir'] is not None:
+        fkwargs['scratchdir'] = os.path.join(fkwargs['texdir'], os.path.expanduser(os.path.expandvars(fkwargs['scratchdir'])))
     if not fkwargs['randassigndatafile'].endswith('.' + fkwargs['randassigndatafilefmt']):
         raise ValueError('Data file name "{0}" lacks appropriate extension ".{1}"'.format(fkwargs['randassigndatafile'], fkwargs['randassigndatafilefmt']))
 
@@ -402,10 +889,11 @@ def _check_directory_structure(*args):
 
 
 
-def _load_data(datafile, datafilefmt):
+def _load_data(datafile, datafilefmt, backup=True):
     '''
     Load the data file from the last run, or if it does not exist, return an
-    empty dictionary.  Backup any existing data in the process.
+    empty dictionary.  Backup any existing data in the process, unless
+    ``backup`` is false.
     '''
     if not os.path.isfile(datafile):
         data = {}
@@ -427,15 +915,172 @@ def _load_data(datafile, datafilefmt):
         # The data file is only written after everything is complete and there
         # are no errors, so copying it in this manner doesn't risk overwriting
         # valid backups with bad data
-        if os.path.isfile(datafile + '.backup'):
-            shutil.copy(datafile + '.backup', datafile + '.backup2')
-        shutil.copy(datafile, datafile + '.backup')
+        if backup:
+            if os.path.isfile(datafile + '.backup'):
+                shutil.copy(datafile + '.backup', datafile + '.backup2')
+            shutil.copy(datafile, datafile + '.backup')
 
     return data
 
 
 
 
+def _merge_data(current, data, added, history=None, reserved=None):
+    '''
+    Merge the solutions created during this run into ``current``, the data as
+    it exists on disk when the run finishes, and return the merged data.
+
+    ``data`` is the data as loaded at the start of the run, plus the new
+    solutions.  ``added`` maps raw student names to the number of solutions
+    appended during this run.  Everything else is taken from ``current``, so
+    that the results of any other runs that finished in the meantime are kept.
+    If another run has also created a new attempt for one of the same
+    students, then the attempt numbers conflict and an error is raised.
+
+    ``history`` maps raw student names to build statistics from this run
+    (``buildtime``, ``buildfailed``).  A student whose first build failed is
+    recorded with no solutions, so that the failure is remembered.
+
+    ``reserved`` maps raw student names to the number of prebuilt attempts
+    appended to ``reserved`` during this run.  Prebuilt attempts are numbered
+    after all issued and reserved attempts, so they conflict if another run
+    has created or prebuilt an attempt in the meantime, but not if another
+    run has only released one.
+    '''
+    for student_raw_str, n in added.items():
+        solutions = data[student_raw_str]['solutions']
+        if student_raw_str not in current:
+            if len(solutions) != n:
+                raise RuntimeError('The data for {0} was removed from the data file by another run'.format(student_raw_str))
+            current[student_raw_str] = data[student_raw_str]
+        elif len(current[student_raw_str]['solutions']) != len(solutions) - n:
+            raise RuntimeError('Another run created an attempt for {0} simultaneously; the attempts created by this run conflict and have been discarded'.format(student_raw_str))
+        else:
+            current[student_raw_str]['solutions'].extend(solutions[-n:])
+    for student_raw_str, n in (reserved or {}).items():
+        record = data[student_raw_str]
+        total = len(record['solutions']) + len(record['reserved'])
+        if student_raw_str not in current:
+            if total != n:
+                raise RuntimeError('The data for {0} was removed from the data file by another run'.format(student_raw_str))
+            current[student_raw_str] = record
+            continue
+        c = current[student_raw_str]
+        if len(c['solutions']) + len(c.get('reserved', [])) != total - n:
+            raise RuntimeError('Another run created an attempt for {0} simultaneously; the attempts created by this run conflict and have been discarded'.format(student_raw_str))
+        c.setdefault('reserved', []).extend(record['reserved'][-n:])
+    for student_raw_str, stats in (history or {}).items():
+        if student_raw_str not in current:
+            if student_raw_str not in data:
+                continue
+            record = data[student_raw_str]
+            current[student_raw_str] = {'name': record['name'],
+                                        'name_raw': record['name_raw'],
+                                        'solutions': []}
+        current[student_raw_str].update(stats)
+    return current
+
+
+
+
+# Lock file in the document directory that serializes builds that use the
+# shared name, attempt, and message files
+_buildlockfile = '.randassign.lock'
+
+
+def _make_builddir(randassigndir, scratchdir=None):
+    '''
+    Create a private build directory for the current run, under
+    ``scratchdir`` if given.
+    '''
+    if scratchdir is not None:
+        if not os.path.isdir(scratchdir):
+            raise RuntimeError('The scratch directory "{0}" does not exist'.format(scratchdir))
+        return os.path.abspath(tempfile.mkdtemp(prefix='randassign-', dir=scratchdir))
+    parent = os.path.join(randassigndir, 'build')
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # Another run may have just created it
+            if not os.path.isdir(parent):
+                raise
+    return os.path.abspath(tempfile.mkdtemp(prefix='run-', dir=parent))
+
+
+
+
+def _primecachedir(a):
+    '''
+    Directory for the files created by priming, which are reused by later
+    runs as long as the document is unchanged.
+    '''
+    return os.path.join(a.randassigndir, 'cache')
+
+
+# Files included by a LaTeX file, and packages and classes that it loads
+_input_re = re.compile(r'\\(?:input|include|subfile)\s*\{([^}]+)\}')
+_package_re = re.compile(r'\\(?:usepackage|RequirePackage|documentclass|LoadClass)\s*(?:\[[^\]]*\])?\s*\{([^}]+)\}')
+
+
+def _texinputs(texfile):
+    '''
+    Return the tex file, along with the files it includes via ``\\input``,
+    ``\\include``, or ``\\subfile`` and the packages and classes it loads,
+    as far as they can be found relative to the document directory
+    (recursively), as absolute paths.
+    '''
+    texdir = os.path.dirname(os.path.abspath(texfile))
+    found = []
+    todo = [os.path.abspath(texfile)]
+    while todo:
+        f = todo.pop()
+        if f in found:
+            continue
+        found.append(f)
+        try:
+            with open(f, encoding='utf8', errors='replace') as fp:
+                text = fp.read()
+        except (IOError, OSError):
+            continue
+        candidates = []
+        for name in _input_re.findall(text):
+            name = name.strip()
+            candidates.append((name, name + '.tex'))
+        for names in _package_re.findall(text):
+            for name in names.split(','):
+                name = name.strip()
+                candidates.append((name + '.sty', name + '.cls'))
+        for c in candidates:
+            for candidate in c:
+                path = os.path.abspath(os.path.join(texdir, candidate))
+                if os.path.isfile(path):
+                    todo.append(path)
+                    break
+    return found
+
+
+def _primekey(texfile, exclude=()):
+    '''
+    Hash of the tex file and its local inputs, which determine the files
+    created by priming.  Inputs in ``exclude``, which differ between
+    students, are not included.
+    '''
+    h = hashlib.sha1()
+    h.update(__version__.encode('utf8'))
+    texdir = os.path.dirname(os.path.abspath(texfile))
+    exclude = [os.path.abspath(os.path.join(texdir, f)) for f in exclude if f is not None]
+    for f in _texinputs(texfile):
+        if f in exclude:
+            continue
+        h.update(os.path.relpath(f, texdir).encode('utf8'))
+        with open(f, 'rb') as fp:
+            h.update(fp.read())
+    return h.hexdigest()
+
+
+
+
 def _save_data(data, datafile, datafilefmt):
     '''
     Save the data file for future runs.
@@ -459,17 +1104,21 @@ def _save_data(data, datafile, datafilefmt):
 
 
 
-def _load_students(student, studentfile, parsestudentfile, parsestudentname):
+def _load_students(student, studentfile, parsestudentfile, parsestudentname, rosterfile=None):
     '''
     Load student data, returning a list of parsed student names and a list of
-    raw student names.
+    raw student names.  If ``rosterfile`` is given, it is used to cache the
+    parsed student file.
 
     If the argument ``student`` is not None, then only return values for that
     student, so that only that student will be processed.  The list of students
     is parsed for an exact match for ``student``, and if this fails, then for
     a unique, full-word, partial match at the beginning or end.
     '''
-    students, students_raw, students_raw_str = parsestudentfile(studentfile, parsestudentname)
+    if rosterfile is None:
+        students, students_raw, students_raw_str = parsestudentfile(studentfile, parsestudentname)
+    else:
+        students, students_raw, students_raw_str = _load_roster(studentfile, parsestudentfile, parsestudentname, rosterfile)
 
     # Deal with case of generating for only a single student
     if student is not None:
@@ -509,47 +1158,131 @@ def _load_students(student, studentfile, parsestudentfile, parsestudentname):
 def _parsestudentfile(studentfile, parsestudentname):
     '''
     Read the student file, and return a list of formatted student names.
+
+    The file is parsed a line at a time.  If parsed names collide, only the
+    colliding names are parsed again with initials.
     '''
     if studentfile.endswith('.txt'):
-        with open(studentfile, encoding='utf8') as f:
-            students_raw = [x.strip() for x in f.readlines() if x.strip()]
+        f = open(studentfile, encoding='utf8')
+        rows = (x.strip() for x in f if x.strip())
     elif studentfile.endswith('.csv'):
         import csv
-        with open(studentfile, encoding='utf8', newline='') as f:
-            students_raw = [x for x in csv.reader(f) if x and all(x)]
+        f = open(studentfile, encoding='utf8', newline='')
+        rows = (x for x in csv.reader(f) if x and all(x))
     else:
         raise ValueError('Student file "{0}" cannot be parsed because it is not .txt or .csv; supply a custom function parsestudentfile() for other formats'.format(studentfile))
 
-    if not students_raw:
+    students = []
+    students_raw = []
+    students_raw_str = []
+    seen = set()
+    # Indices of the students with each parsed name
+    parsed = {}
+    with f:
+        for student_raw in rows:
+            if not isinstance(student_raw, list):
+                student_raw_str = student_raw
+            elif len(student_raw) == 1:
+                student_raw_str = student_raw[0].strip()
+            elif len(student_raw) == 2:
+                student_raw_str = ', '.join([student_raw[0].strip(), student_raw[1].strip()])
+            else:
+                raise RuntimeError('Cannot deal with raw names consisting of lists of length greater than 2')
+            if student_raw_str in seen:
+                if studentfile.endswith('.txt'):
+                    raise RuntimeError('The student file contains duplicate names')
+                else:
+                    raise RuntimeError('The student file contains duplicate names, or the conversion of CSV cells into a string yielded duplicates')
+            seen.add(student_raw_str)
+            student = parsestudentname(student_raw)
+            parsed.setdefault(student, []).append(len(students))
+            students.append(student)
+            students_raw.append(student_raw)
+            students_raw_str.append(student_raw_str)
+
+    if not students:
         raise RuntimeError('Parsing the student file gave no students')
 
-    if not isinstance(students_raw[0], list):
-        students_raw_str = [x.strip() for x in students_raw]
-    else:
-        if len(student_raw[0]) == 1:
-            students_raw_str = [x[0].strip() for x in students_raw]
-        elif len(student_raw) == 2:
-            students_raw_str = [', '.join(x[0].strip(), x[1].strip()) for x in students_raw]
-        else:
-            raise RuntimeError('Cannot deal with raw names consisting of lists of length greater than 2')
-    if len(students_raw_str) != len(set(students_raw_str)):
-        if studentfile.endswith('.txt'):
-            raise RuntimeError('The student file contains duplicate names')
-        else:
-            raise RuntimeError('The student file contains duplicate names, or the conversion of CSV cells into a string yielded duplicates')
-
     # Need to make sure that the parsed names are unique
-    students = [parsestudentname(x) for x in students_raw]
-    if len(students) != len(set(students)):
-        students = [parsestudentname(x, initials=True) for x in students_raw]
-    if len(students) != len(set(students)):
-        raise RuntimeError('Student file yielded duplicate names after parsing')
+    collisions = [n for indices in parsed.values() if len(indices) > 1 for n in indices]
+    if collisions:
+        for n in collisions:
+            students[n] = parsestudentname(students_raw[n], initials=True)
+        if len(students) != len(set(students)):
+            raise RuntimeError('Student file yielded duplicate names after parsing')
 
     return students, students_raw, students_raw_str
 
 
 
 
+def _rosterfile(a):
+    '''
+    Cache of the parsed student file, kept next to the data file.
+    '''
+    return '{0}.roster.json'.format(a.randassigndatafile[:-len(a.randassigndatafilefmt)-1])
+
+
+def _load_roster(studentfile, parsestudentfile, parsestudentname, rosterfile):
+    '''
+    Parse the student file, using the cached result in ``rosterfile`` if the
+    student file is unchanged.
+
+    The cache is used directly if the student file's modification time and
+    size are unchanged.  Otherwise, the student file is hashed, and the cache
+    is used if the hash matches, which avoids parsing again after a file is
+    only touched or copied.
+    '''
+    st = os.stat(studentfile)
+    cache = None
+    if os.path.isfile(rosterfile):
+        try:
+            with open(rosterfile, encoding='utf8') as f:
+                cache = json.load(f)
+            if cache.get('studentfile') != os.path.abspath(studentfile):
+                cache = None
+        except ValueError:
+            # A corrupt cache is simply replaced
+            cache = None
+    if cache is not None and cache['mtime'] == st.st_mtime and cache['size'] == st.st_size:
+        return cache['students'], cache['students_raw'], cache['students_raw_str']
+
+    h = hashlib.sha1()
+    with open(studentfile, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    if cache is not None and cache['sha1'] == digest:
+        s = cache['students'], cache['students_raw'], cache['students_raw_str']
+    else:
+        s = parsestudentfile(studentfile, parsestudentname)
+    cache = {'studentfile': os.path.abspath(studentfile),
+             'mtime': st.st_mtime, 'size': st.st_size, 'sha1': digest,
+             'students': s[0], 'students_raw': s[1], 'students_raw_str': s[2]}
+    # Write to a temp file and rename, so that simultaneous runs never see a
+    # partial cache
+    tmp = '{0}.{1}.tmp'.format(rosterfile, os.getpid())
+    with open(tmp, 'w', encoding='utf8') as f:
+        f.write(json.dumps(cache, ensure_ascii=False))
+    _replace_file(tmp, rosterfile)
+    return s
+
+
+def _replace_file(src, dst):
+    '''
+    Rename ``src`` to ``dst``, replacing any existing ``dst``.
+    '''
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2
+        if os.path.isfile(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+
+
 def _parsestudentname(studentname, initials=False):
     '''
     Parse individual student names into the form that will actually appear on
@@ -615,84 +1348,1053 @@ def _parsestudentname(studentname, initials=False):
 
 
 
-def _run(data, createdfiles, students, students_raw, student_raw_str,
-         verbose, silent, texcmd, texfile, namefile, attemptfile, pythontexcmd,
-         msgfilepattern, assigndir, multipleattempts):
-    '''
-    Generate assignments for all specified students, move the assignments to
-    the assigndir, and return a dictionary of solutions.
+class _MakeRun(object):
     '''
-    pdffile = '{0}.{1}'.format(texfile.rsplit('.', 1)[0], 'pdf')
+    State shared by the stages of a single run of ``make()`` or
+    ``make_async()``.
 
-
-    # Clean up any existing message files
-    # This ensures that any such files in the future constitute actual messages,
-    # rather than leftovers from previous runs
-    for f in fnmatch.filter(os.listdir('.'), msgfilepattern):
-        os.remove(f)
-
-
-    for n, (student, student_raw, student_raw_str) in enumerate(zip(students, students_raw, student_raw_str)):
-        if student_raw_str not in data:
-            data[student_raw_str] = {'name': student,
-                                     'name_raw': student_raw,
-                                     'solutions': []}
-
-        if namefile is not None:
-            with open(namefile, 'w', encoding='utf8') as f:
-                f.write('{0}\\endinput\n'.format(student))
-
-        if multipleattempts:
-            attempt = len(data[student_raw_str]['solutions']) + 1
-            with open(attemptfile, 'w', encoding='utf8') as f:
-                f.write('{0}\\endinput\n'.format(attempt))
+    Created files and directories are tracked so that they can be removed if
+    an error occurs.  The data is only locked while it is loaded and while
+    the results of the run are merged into it and saved; see ``finish()``.
+    '''
+    def __init__(self, a):
+        self.a = a
+        self.createdfiles = []
+        self.createddirs = []
+        self.data = None
+        # Number of solutions added for each student during this run
+        self.added = {}
+        # Number of prebuilt attempts added for each student during this run,
+        # and for each entry in the students lists under `prebuildattempts`,
+        # which of the student's prebuilt attempts it is
+        self.reserved = {}
+        self.prebuild = None
+        # Build statistics for each student, saved in the data for scheduling
+        # later runs
+        self.history = {}
+        self.students = None
+        self.students_raw = None
+        self.students_raw_str = None
+        self.datalock = FileLock(a.randassigndatafile + '.lock', silent=a.silent)
+        # Guards `data` and `added` when students are built simultaneously
+        self.lock = threading.Lock()
+        callbacks = []
+        if not a.verbose and not a.silent:
+            callbacks.append(TerminalProgress())
+        if a.progress is not None:
+            callbacks.append(a.progress)
+        self.progress = Progress(callbacks)
+        if a.trace is None:
+            self.tracer = NullTracer()
         else:
+            self.tracer = Tracer('randassign {0}'.format(a.texfile))
+        self.tracefile = None
+        # Number of PythonTeX sessions in the document, once known
+        self.sessions = None
+        # Number of simultaneous builds under `cores`, once chosen
+        self.builds = None
+        # Archive for assignments, with `assignsink` "zip" or "tar"
+        self.sink = None
+        self.bundle = None
+        # Hash of the document for reusing the files created by priming, with
+        # `primecache`
+        self.primekey = None
+        # Time at which the run started, for telling assignments created by
+        # other runs since then from those left by earlier runs
+        self.started = time.time()
+
+    def start(self, students=None):
+        '''
+        Load data and students.  ``students`` may give the students as
+        already loaded by ``_load_students()``, so that documents built
+        together share a single roster.
+        '''
+        a = self.a
+        # All paths in `a` are absolute, and all output stays with the .tex
+        # file, or in subdirectories.  Created files are cleaned up by
+        # `rollback()` if the run fails, rather than at exit, so that nothing
+        # accumulates in long-running processes.
+        self.tracefile = a.trace
+
+        _check_directory_structure(a.randassigndir, a.solndir, a.assigndir, _logdir(a))
+
+        self.progress.phase('load')
+        with self.tracer.span('load data'):
+            with self.datalock:
+                self.data = _load_data(a.randassigndatafile, a.randassigndatafilefmt)
+
+        # The roster can only be cached when it is parsed by the default
+        # functions, since custom functions may depend on anything
+        if a.parsestudentfile is _parsestudentfile and a.parsestudentname is _parsestudentname:
+            rosterfile = _rosterfile(a)
+        else:
+            rosterfile = None
+        if students is not None:
+            s = students
+        else:
+            with self.tracer.span('load students'):
+                s = _load_students(a.student, a.studentfile, a.parsestudentfile, a.parsestudentname, rosterfile)
+        self.students, self.students_raw, self.students_raw_str = s
+        if a.prebuildattempts and not a.onlysolutions:
+            # Each student appears once for each attempt, so that attempts are
+            # scheduled and reported like any other builds
+            k = a.prebuildattempts
+            self.students = [x for x in self.students for _ in range(k)]
+            self.students_raw = [x for x in self.students_raw for _ in range(k)]
+            self.students_raw_str = [x for x in self.students_raw_str for _ in range(k)]
+            self.prebuild = [i for _ in range(len(s[0])) for i in range(k)]
+            _check_directory_structure(_reserveddir(a))
+
+        if a.assignsink != 'dir' and not a.onlysolutions:
+            sink = sinks[a.assignsink](_archivefile(a), silent=a.silent)
+            sink.open()
+            self.sink = sink
+        if a.bundle and not a.onlysolutions:
+            _check_directory_structure(_bundledir(a))
+            self.bundle = PrintBundle(os.path.join(_bundledir(a), '{0}_bundle.tex'.format(a.texfile.rsplit('.', 1)[0])), a.bundleduplex)
+            self.createdfiles.append(self.bundle.texfile)
+            self.bundle.open()
+
+        if a.primecache and not a.onlysolutions:
+            # The name and attempt files are written for each student
+            self.primekey = _primekey(os.path.join(a.texdir, a.texfile), (a.namefile, a.attemptfile))
+
+        if a.preflight:
+            with self.tracer.span('preflight'):
+                problems = self.preflight()
+            if problems:
+                self.rollback()
+                raise RuntimeError('Found {0} problem(s) before building assignments:\n  {1}'.format(len(problems), '\n  '.join(problems)))
+
+    def preflight(self):
+        '''
+        Check for problems that would otherwise only be found after building
+        assignments, and return a list of descriptions.  This covers the
+        commands that will be run, the data for each student, and the files
+        that each assignment will be saved as, including different students
+        whose names give the same file name.
+        '''
+        a = self.a
+        problems = []
+        cmds = [('texcmd', a.texcmd), ('pythontexcmd', a.pythontexcmd)] if not a.onlysolutions else []
+        if a.solncmd:
+            cmds.append(('solncmd', a.solncmd))
+        for k, cmd in cmds:
+            if which(cmd[0]) is None:
+                problems.append('Could not find the command "{0}" for "{1}"'.format(cmd[0], k))
+        if a.onlysolutions:
+            return problems
+
+        names = {}
+        for n, student_raw_str in enumerate(self.students_raw_str):
+            student = self.students[n]
+            record = self.data.get(student_raw_str, {'solutions': []})
+            try:
+                if not isinstance(record.get('solutions'), list):
+                    raise RuntimeError('The data for {0} is invalid; it has no list of solutions'.format(student))
+                if not a.multipleattempts and record['solutions']:
+                    raise RuntimeError('Although "multipleattempts" is False, there are already solutions for {0}'.format(student))
+                attempt = self.next_attempt(n, record)
+                name, assigndir = self.assignfile(student_raw_str, attempt)
+            except Exception as e:
+                problems.append(str(e))
+                continue
+            if name in names:
+                if names[name] != student_raw_str:
+                    problems.append('The assignments for "{0}" and "{1}" would both be saved as "{2}"'.format(names[name], student_raw_str, name))
+                continue
+            names[name] = student_raw_str
+            if self.sink is not None:
+                if self.sink.exists(name):
+                    problems.append('The assignment "{0}" already exists in archive "{1}"'.format(name, self.sink.path))
+            elif os.path.isfile(os.path.join(assigndir, *name.split('/'))):
+                problems.append('The assignment "{0}" already exists'.format(os.path.join(assigndir, *name.split('/'))))
+        return problems
+
+    def cleanup(self):
+        '''
+        Remove all files created during the run, and all private build
+        directories, and restore the archive of assignments.
+        '''
+        if self.sink is not None:
+            sink = self.sink
+            self.sink = None
+            sink.rollback()
+        if self.bundle is not None:
+            self.bundle.close()
+        for f in self.createdfiles:
+            try:
+                os.remove(f)
+            except:
+                pass
+        for d in self.createddirs:
+            shutil.rmtree(d, ignore_errors=True)
+
+    def commit(self):
+        '''
+        Keep created files, since no errors occurred.
+        '''
+        if self.sink is not None:
+            self.sink.commit()
+            self.sink = None
+        self.createdfiles[:] = []
+        self.cleanup()
+        self.createddirs[:] = []
+        if self.tracefile is not None:
+            self.tracer.write(self.tracefile)
+
+    def rollback(self):
+        '''
+        Discard everything created during the run.
+        '''
+        self.cleanup()
+        self.createdfiles[:] = []
+        self.createddirs[:] = []
+        # The trace is saved regardless, since it may help explain the error
+        if self.tracefile is not None:
+            self.tracer.write(self.tracefile)
+        self.progress.phase('done')
+
+    def slots(self, n):
+        '''
+        Create locations for building assignments.  Without ``isolate``, there
+        is only the document directory, which is shared by ``n`` slots with
+        ``injection`` "cmdline" and is otherwise a single slot.  With
+        ``isolate``, ``n`` private build directories are created, so that
+        ``n`` students may be built simultaneously.
+        '''
+        if not self.a.isolate:
+            if self.a.injection == 'file':
+                n = 1
+            slots = []
+            for k in range(1, n+1):
+                self.tracer.track(k, 'build {0}'.format(k) if n > 1 else 'build')
+                slots.append(_BuildSlot(self.a, index=k))
+            return slots
+        slots = []
+        for k in range(1, n+1):
+            builddir = _make_builddir(self.a.randassigndir, self.a.scratchdir)
+            self.createddirs.append(builddir)
+            self.tracer.track(k, 'build {0}'.format(k))
+            slots.append(_BuildSlot(self.a, builddir, index=k))
+        return slots
+
+    def iterbuild(self, slots=None):
+        '''
+        Generate assignments for all specified students, and copy the
+        assignments to the assigndir.  Up to ``jobs`` students are built
+        simultaneously.  Yield a ``StudentResult`` as each assignment is
+        completed.
+
+        Existing ``slots`` may be supplied, for example to reuse warm build
+        directories between runs; otherwise, slots are created for the run.
+        '''
+        a = self.a
+        self.progress.phase('build', total=len(self.students))
+        if slots is None and a.isolate:
+            slots = self.slots(self.jobs())
+        if slots is not None and all(slot.private for slot in slots):
+            for r in self._iterbuild(slots):
+                yield r
+        else:
+            with FileLock(os.path.join(a.texdir, _buildlockfile), silent=a.silent):
+                for r in self._iterbuild(slots or self.slots(self.jobs())):
+                    yield r
+
+    def jobs(self):
+        '''
+        Number of students to build simultaneously.  Under ``cores``, the
+        cores are split by the number of PythonTeX sessions in the document,
+        so that each build has a core for each of its sessions:  ``cores //
+        sessions`` students are built simultaneously.  The sessions are
+        counted from the files left by an earlier run, if there are any;
+        otherwise, each core gets a student.  The split is made once per run.
+        '''
+        if self.a.cores is None:
+            jobs = self.a.jobs
+        else:
+            if self.builds is None:
+                sessions = self.sessions or self.saved_sessions() or 1
+                self.builds = max(1, self.a.cores // min(sessions, self.a.cores))
+            jobs = self.builds
+        return max(1, min(jobs, len(self.students)))
+
+    def saved_sessions(self):
+        '''
+        Count the PythonTeX sessions in the code file saved by priming, with
+        ``primecache``, or else in the code file left in the document
+        directory by the last compile.  Return None if there is neither.
+        '''
+        stem = self.a.texfile.rsplit('.', 1)[0]
+        candidates = []
+        cachedir = _primecachedir(self.a)
+        if os.path.isdir(cachedir):
+            candidates.extend(os.path.join(cachedir, fname) for fname in sorted(os.listdir(cachedir))
+                              if fname.startswith(stem + '.') and fname.endswith('.pytxcode'))
+        candidates.append(os.path.join(self.a.texdir, stem + '.pytxcode'))
+        for pytxcodefile in candidates:
+            if os.path.isfile(pytxcodefile):
+                return _count_sessions(pytxcodefile)
+        return None
+
+    def command(self, slot, label, cmd):
+        '''
+        Return the command to run for step ``label`` of a build in ``slot``.
+
+        Under ``cores``, the PythonTeX command gets the cores of each build,
+        ``cores`` divided by the number of builds running, but no more jobs
+        than there are sessions.  At the end of a run, when fewer students
+        remain than there are builds, each build gets more cores.
+        '''
+        if label != 'pythontex' or self.a.cores is None:
+            return cmd
+        if self.sessions is None:
+            # The first LaTeX run in the slot has created the PythonTeX code
+            # file for the current document, so this count is exact
+            self.sessions = slot.sessions()
+        snapshot = self.progress.snapshot()
+        remaining = max(1, snapshot.total - snapshot.completed)
+        pythontexjobs = max(1, min(self.sessions, self.a.cores // min(remaining, self.jobs())))
+        return _set_pythontex_jobs(cmd, pythontexjobs)
+
+    def _iterbuild(self, slots):
+        todo = collections.deque(self.order())
+        errors = []
+        stop = []
+        def next_student():
+            with self.lock:
+                if errors or stop or not todo:
+                    return None
+                return todo.popleft()
+
+        if len(slots) == 1:
+            while True:
+                n = next_student()
+                if n is None:
+                    return
+                yield self.build_student(slots[0], n)
+
+        results = queue.Queue()
+        def work(slot):
+            try:
+                while True:
+                    n = next_student()
+                    if n is None:
+                        return
+                    results.put(self.build_student(slot, n))
+            except Exception as e:
+                with self.lock:
+                    errors.append(e)
+            finally:
+                # Signal that this worker is finished
+                results.put(None)
+        threads = [threading.Thread(target=work, args=(slot,)) for slot in slots]
+        for t in threads:
+            t.start()
+        try:
+            running = len(threads)
+            while running:
+                r = results.get()
+                if r is None:
+                    running -= 1
+                else:
+                    yield r
+        finally:
+            # If the consumer of the results stops early, let running builds
+            # finish but don't start any more
+            stop.append(True)
+            for t in threads:
+                t.join()
+        if errors:
+            raise errors[0]
+
+    def order(self):
+        '''
+        Return the numbers of the students in the order in which they should
+        be built.
+
+        Under the "adaptive" schedule, students whose last build failed come
+        first, so that problems surface early.  Students without a recorded
+        build time come next, followed by the remaining students from the
+        longest recorded build time to the shortest, so that slow builds do
+        not straggle at the end of runs with simultaneous builds.  Otherwise,
+        ties keep the order of the student file.
+        '''
+        order = list(range(len(self.students)))
+        if self.a.schedule == 'roster':
+            return order
+        def key(n):
+            record = self.data.get(self.students_raw_str[n], {})
+            if record.get('buildfailed'):
+                return (0, 0)
+            buildtime = record.get('buildtime')
+            if buildtime is None:
+                return (1, 0)
+            return (2, -buildtime)
+        order.sort(key=key)
+        return order
+
+    def build_student(self, slot, n):
+        '''
+        Build the assignment for student number ``n`` in ``slot``, returning
+        a ``StudentResult``.  Failed builds are retried up to ``retries``
+        times, each time with a fresh random seed.
+        '''
+        seed = None
+        tries = 0
+        while True:
+            start = time.time()
+            timings = {}
             attempt = None
-
-        # For the first student in the list, we need to run tex, then pythontex,
-        # then tex again to produce the final pdf.  For subsequent students,
-        # the first tex run may be omitted, since the temp files that pythontex
-        # needs will already exist, and a following tex run will pick up the
-        # modified namefile and attemptfile for the final pdf.
-        if n == 0:
-            if verbose:
-                print('Running command {0}'.format(texcmd))
-                subprocess.call(texcmd)
-            else:
-                if not silent:
-                    print('Generating assignment {0}/{1}\r'.format(str(n+1).rjust(len(str(len(students)))), len(students)), end='')
-                    sys.stdout.flush()
+            try:
+                attempt = self.prepare_student(slot, n)
+                env = slot.environ(seed)
+                logfile = self.logfile(n, attempt)
+                for label, cmd in self.steps(slot):
+                    cmd = self.command(slot, label, cmd)
+                    self.progress.step(self.students[n], label, attempt)
+                    t = time.time()
+                    _call(cmd, self.a.verbose, cwd=slot.dir, env=env, logfile=logfile)
+                    self.command_done(slot, label, cmd, t, timings)
+                slot.primed = True
+                result = self.finish_student(slot, n, attempt, timings, start, logfile)
+                self.progress.finish(self.students[n], attempt=attempt)
+                self.trace_student(slot, n, attempt, tries, start)
+                return result
+            except Exception:
+                self.trace_student(slot, n, attempt, tries, start, failed=True)
+                result = self.failure(slot, n, tries, attempt, timings, start)
+                if result is not None:
+                    self.progress.finish(self.students[n], failed=True, attempt=attempt)
+                    return result
+            tries += 1
+            seed = _newseed()
+
+    def steps(self, slot):
+        '''
+        Yield the commands for building the next assignment in ``slot``, as
+        (label, command) pairs.  Each command must be run before the next is
+        requested.
+
+        With ``autorerun``, the final LaTeX run is repeated until it no longer
+        changes the auxiliary files, up to ``maxtexpasses`` runs, so that
+        cross-references, page counts, and page breaks that depend on
+        PythonTeX output settle without a fixed number of runs.
+        '''
+        a = self.a
+        for label, cmd in slot.commands():
+            if label != 'tex' or not a.autorerun:
+                yield label, cmd
+                continue
+            passes = 0
+            while True:
+                state = slot.texstate()
+                yield label, cmd
+                passes += 1
+                if passes >= a.maxtexpasses or slot.texstate() == state:
+                    break
+
+    def command_done(self, slot, label, cmd, t, timings):
+        '''
+        Record the time for a command started at ``t``.
+        '''
+        end = time.time()
+        timings[label] = timings.get(label, 0) + end - t
+        self.tracer.add(label, 'command', t, end, slot.index, {'cmd': ' '.join(cmd)})
+        if label == 'prime':
+            self.save_prime(slot)
+
+    def primefiles(self, slot):
+        '''
+        Return the files created by priming ``slot`` that are needed by
+        PythonTeX and the next LaTeX run, as (cached file, file in slot)
+        pairs.  Return None without ``primecache``.
+
+        Cached files are named by a hash of the document and by a hash of the
+        commands for the slot, since the files depend on where the document
+        is compiled from, and on the job name with ``injection`` "cmdline".
+        The PythonTeX code file comes last, so that its presence in the cache
+        means that everything has been saved.
+        '''
+        if self.primekey is None:
+            return None
+        slothash = hashlib.sha1(json.dumps([slot.texcmd, slot.pythontexcmd]).encode('utf8')).hexdigest()[:16]
+        stem = self.a.texfile.rsplit('.', 1)[0]
+        prefix = os.path.join(_primecachedir(self.a), '{0}.{1}.{2}'.format(stem, self._primehash(), slothash))
+        return [(prefix + '.' + ext, slot.pytxcodefile.rsplit('.', 1)[0] + '.' + ext)
+                for ext in ('aux', 'pytxcode')]
+
+    def _primehash(self):
+        '''
+        Hash of the document, shared by the cached files of all slots.
+        '''
+        return hashlib.sha1(self.primekey.encode('utf8')).hexdigest()[:16]
+
+    def restore_prime(self, slot):
+        '''
+        Prime ``slot`` from the cache, if the cache is for the current
+        document.
+        '''
+        pairs = self.primefiles(slot)
+        if not pairs or not all(os.path.isfile(cached) for cached, _ in pairs):
+            return
+        for cached, f in pairs:
+            shutil.copy(cached, f)
+        slot.primed = True
+
+    def save_prime(self, slot):
+        '''
+        Save the files created by priming ``slot`` in the cache, replacing
+        those for any previous version of the document.  The files for other
+        slots are kept, since each slot has its own.
+        '''
+        pairs = self.primefiles(slot)
+        if not pairs or not all(os.path.isfile(f) for _, f in pairs):
+            return
+        cachedir = _primecachedir(self.a)
+        _check_directory_structure(cachedir)
+        stem = self.a.texfile.rsplit('.', 1)[0]
+        current = '{0}.{1}.'.format(stem, self._primehash())
+        for fname in os.listdir(cachedir):
+            if fname.startswith(stem + '.') and not fname.startswith(current) and fname.rsplit('.', 1)[-1] in ('aux', 'pytxcode'):
                 try:
-                    subprocess.check_output(texcmd)
-                except subprocess.CalledProcessError as e:
-                    # `output` is bytes; need a string to print nicely under Python 3
-                    print(e.output.decode(sys.getdefaultencoding()), file=sys.stderr)
-                    raise
+                    os.remove(os.path.join(cachedir, fname))
+                except OSError:
+                    pass
+        # Simultaneous builds may save at the same time, so each writes a
+        # temp file that is renamed into place
+        for cached, f in pairs:
+            tmp = '{0}.{1}.{2}.tmp'.format(cached, os.getpid(), id(slot))
+            shutil.copy(f, tmp)
+            _replace_file(tmp, cached)
+
+    def trace_student(self, slot, n, attempt, tries, start, failed=False):
+        '''
+        Record a span for a try at building the assignment for student number
+        ``n``.
+        '''
+        args = {'student': self.students_raw_str[n], 'attempt': attempt}
+        if tries:
+            args['retry'] = tries
+        if failed:
+            args['failed'] = True
+        self.tracer.add(self.students[n], 'student', start, time.time(), slot.index, args)
+
+    def logfile(self, n, attempt):
+        '''
+        Rotate the log file for the current build of student number ``n``,
+        and return its name.
+        '''
+        name = _sanitize(self.students_raw_str[n])
+        if attempt is not None:
+            name += '_{0}'.format(attempt)
+        logfile = os.path.abspath(os.path.join(_logdir(self.a), name + '.log'))
+        _rotate_log(logfile)
+        return logfile
+
+    def failure(self, slot, n, tries, attempt, timings, start):
+        '''
+        Handle a failed try at building the assignment for student number
+        ``n``.  This must be called from within the ``except`` clause that
+        caught the error.
+
+        Return None if the build should be tried again.  Otherwise, if
+        ``keepgoing``, return a ``StudentResult`` for the failed build, and
+        if not, re-raise the error.
+        '''
+        a = self.a
+        e = sys.exc_info()[1]
+        # The temp files in the slot may be incomplete after a failure
+        slot.primed = False
+        if tries < a.retries:
+            if not a.silent:
+                print('Retrying assignment for {0} after error:  {1}'.format(self.students[n], e), file=sys.stderr)
+            return None
+        _show_tail(e, a.silent)
+        if not a.keepgoing:
+            raise
+        if not a.silent:
+            print('Failed to generate assignment for {0}:  {1}'.format(self.students[n], e), file=sys.stderr)
+        timings['total'] = time.time() - start
+        with self.lock:
+            self.history[self.students_raw_str[n]] = {'buildfailed': True}
+        logfile = getattr(e, 'logfile', None)
+        return StudentResult(self.students[n], self.students_raw_str[n],
+                             attempt, None, None, timings, e, logfile)
+
+    def prepare_student(self, slot, n):
+        '''
+        Write the name and attempt files for student number ``n`` in
+        ``slot``, returning the attempt number.
+        '''
+        student = self.students[n]
+        student_raw_str = self.students_raw_str[n]
+        with self.lock:
+            if student_raw_str not in self.data:
+                self.data[student_raw_str] = {'name': student,
+                                              'name_raw': self.students_raw[n],
+                                              'solutions': []}
+            attempt = self.next_attempt(n, self.data[student_raw_str])
+        if not slot.primed:
+            self.restore_prime(slot)
+        slot.write(student, attempt)
+        return attempt
+
+    def next_attempt(self, n, record):
+        '''
+        Return the number of the attempt to build for student number ``n``,
+        given the student's data ``record``.
+        '''
+        if self.prebuild is not None:
+            # Attempts prebuilt during this run are not counted, since each
+            # knows its place from `prebuild`
+            reserved = len(record.get('reserved', [])) - self.reserved.get(self.students_raw_str[n], 0)
+            return len(record['solutions']) + reserved + self.prebuild[n] + 1
+        if record.get('reserved'):
+            raise RuntimeError('There are {0} prebuilt attempt(s) for {1}; release them with release() or --release before building new attempts'.format(len(record['reserved']), self.students[n]))
+        if self.a.multipleattempts:
+            return len(record['solutions']) + 1
+        return None
+
+    def assignfile(self, student_raw_str, attempt):
+        '''
+        Return the name of the assignment for a student and attempt, and the
+        directory (or archive) in which it is saved.
+        '''
+        if self.prebuild is not None:
+            # Prebuilt attempts are kept aside, and only moved into place in
+            # `assigndir` when released
+            return _assignname(student_raw_str, attempt), _reserveddir(self.a)
+        return _assignname(student_raw_str, attempt, self.a.assignlayout), self.a.assigndir
+
+    def finish_student(self, slot, n, attempt, timings, start, logfile=None):
+        '''
+        Save the solutions for student number ``n`` from the messages in
+        ``slot``, and copy the assignment to the assigndir.  Return a
+        ``StudentResult``, completing ``timings`` with the total time since
+        ``start``.
+        '''
+        a = self.a
+        student = self.students[n]
+        student_raw_str = self.students_raw_str[n]
+        with self.tracer.span('messages', tid=slot.index):
+            newsoln = slot.solutions()
+
+        if not a.multipleattempts and self.data[student_raw_str]['solutions']:
+            raise RuntimeError('Although "multipleattempts" is False, there are multiple solutions for {0}'.format(student))
 
-        if verbose:
-            print('Running command {0}'.format(pythontexcmd))
-            subprocess.call(pythontexcmd)
-            print('Running command {0}'.format(texcmd))
-            subprocess.call(texcmd)
+        # Name files using a sanitized form of the raw student name
+        name, assigndir = self.assignfile(student_raw_str, attempt)
+        if self.sink is not None:
+            with self.tracer.span('copy', tid=slot.index):
+                self.sink.add(slot.pdffile, name, student_raw_str, attempt)
+            newfile = name
         else:
-            if not silent:
-                print('Generating assignment {0}/{1}\r'.format(str(n+1).rjust(len(str(len(students)))), len(students)), end='')
-                sys.stdout.flush()
+            newfile = os.path.join(assigndir, *name.split('/'))
+            newdir = os.path.dirname(newfile)
+            if not os.path.isdir(newdir):
+                try:
+                    os.makedirs(newdir)
+                except OSError:
+                    # Another build may have just created it
+                    if not os.path.isdir(newdir):
+                        raise
+            # Need `abspath()` to ensure functioning
+            newfile = os.path.abspath(newfile)
+            # The assignment is created exclusively before the PDF replaces
+            # it, so that a simultaneous run building the same attempt can
+            # never overwrite it, or remove it when rolling back
             try:
-                subprocess.check_output(pythontexcmd)
-            except subprocess.CalledProcessError as e:
-                print(e.output.decode(sys.getdefaultencoding()), file=sys.stderr)
-                raise
+                os.close(os.open(newfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                try:
+                    simultaneous = os.stat(newfile).st_mtime >= self.started
+                except OSError:
+                    simultaneous = True
+                if simultaneous:
+                    raise RuntimeError('Another run created an attempt for {0} simultaneously; the attempts created by this run conflict and have been discarded'.format(student_raw_str))
+                raise RuntimeError('The assignment "{0}" already exists; this may be due to a previous error, or two randassign files in the same directory (in which case, consider setting "randassigndir" to a custom value)'.format(newfile))
+            with self.lock:
+                self.createdfiles.append(newfile)
             try:
-                subprocess.check_output(texcmd)
-            except subprocess.CalledProcessError as e:
-                print(e.output.decode(sys.getdefaultencoding()), file=sys.stderr)
+                with self.tracer.span('copy', tid=slot.index):
+                    if slot.private:
+                        # The PDF in a private build directory is not needed
+                        # afterward, so it may simply be renamed, or copied
+                        # once if the build directory is on another file system
+                        shutil.move(slot.pdffile, newfile)
+                    else:
+                        shutil.copy(slot.pdffile, newfile)
+            except:
+                # Don't leave a partial copy behind if the run keeps going
+                with self.lock:
+                    self.createdfiles.remove(newfile)
+                if os.path.isfile(newfile):
+                    os.remove(newfile)
                 raise
 
+        if self.bundle is not None:
+            self.bundle.add(newfile, student, n)
+
+        # Solutions are only saved once everything else has succeeded, so that
+        # failed builds leave no trace in the data
+        timings['total'] = time.time() - start
+        with self.lock:
+            if self.prebuild is not None:
+                self.data[student_raw_str].setdefault('reserved', []).append({'attempt': attempt,
+                                                                              'solutions': newsoln,
+                                                                              'assignment': name})
+                self.reserved[student_raw_str] = self.reserved.get(student_raw_str, 0) + 1
+            else:
+                self.data[student_raw_str]['solutions'].append(newsoln)
+                self.added[student_raw_str] = self.added.get(student_raw_str, 0) + 1
+            # The initial LaTeX run is needed once per build location rather
+            # than once per student, so it isn't counted
+            self.history[student_raw_str] = {'buildtime': timings['total'] - timings.get('prime', 0),
+                                             'buildfailed': False}
+        return StudentResult(student, student_raw_str, attempt, newfile,
+                             newsoln, timings, None, logfile)
+
+    def closesink(self):
+        '''
+        Finish writing the archive of assignments, if any.  It is still
+        restored if an error occurs before ``commit()``.
+        '''
+        if self.sink is not None:
+            with self.tracer.span('close archive'):
+                self.sink.close()
+
+    def closebundle(self):
+        '''
+        Finish writing the print bundle, if any, and return the commands for
+        compiling it.  LaTeX is run twice, so that the bookmarks are complete.
+        '''
+        if self.bundle is None:
+            return []
+        self.bundle.close()
+        if not self.bundle.count:
+            return []
+        with self.lock:
+            self.createdfiles.append(self.bundle.pdffile)
+        cmd = self.a.texcmd[:-1] + [os.path.basename(self.bundle.texfile)]
+        return [cmd, cmd]
+
+    def makebundle(self):
+        '''
+        Compile the print bundle, if any.
+        '''
+        cmds = self.closebundle()
+        if not cmds:
+            return
+        self.progress.phase('bundle')
+        logfile = os.path.abspath(os.path.join(_logdir(self.a), 'bundle.log'))
+        _rotate_log(logfile)
+        with self.tracer.span('bundle'):
+            for cmd in cmds:
+                _call(cmd, self.a.verbose, cwd=_bundledir(self.a), logfile=logfile, silent=self.a.silent)
+
+    def merge(self):
+        '''
+        Merge the results of the run into the data as it currently exists on
+        disk, picking up anything saved by other runs since the data was
+        loaded.  Must be called while holding ``datalock``.
+        '''
+        a = self.a
+        self.prune_reserved()
+        current = _load_data(a.randassigndatafile, a.randassigndatafilefmt, backup=False)
+        self.data = _merge_data(current, self.data, self.added, self.history, self.reserved)
+
+    def prune_reserved(self):
+        '''
+        Discard prebuilt attempts that follow a failed attempt for the same
+        student under ``keepgoing``.  Attempts must be released in order, so
+        they can only be kept up to the first gap.
+        '''
+        for student_raw_str, n in list(self.reserved.items()):
+            record = self.data[student_raw_str]
+            old = record['reserved'][:-n]
+            new = sorted(record['reserved'][-n:], key=lambda x: x['attempt'])
+            nextattempt = len(record['solutions']) + len(old) + 1
+            kept = []
+            for entry in new:
+                if entry['attempt'] != nextattempt:
+                    f = os.path.abspath(os.path.join(_reserveddir(self.a), *entry['assignment'].split('/')))
+                    if f in self.createdfiles:
+                        self.createdfiles.remove(f)
+                    if os.path.isfile(f):
+                        os.remove(f)
+                    if not self.a.silent:
+                        print('Discarded prebuilt attempt {0} for {1}, since an earlier attempt failed'.format(entry['attempt'], record['name']), file=sys.stderr)
+                    continue
+                kept.append(entry)
+                nextattempt += 1
+            record['reserved'] = old + kept
+            if kept:
+                self.reserved[student_raw_str] = len(kept)
+            else:
+                del self.reserved[student_raw_str]
+
+    def writesoln(self, solncmd):
+        '''
+        Write the solutions, post-processing them with ``solncmd``.
+        '''
+        a = self.a
+        # The default `writesoln()` requires all arguments to function correctly,
+        # but is written so that all arguments but `data` are keyword arguments.
+        # This makes it simple to write custom functions of the form
+        # `custom_writesoln(data, **kwargs)`, which can ignore any keyword args
+        # that aren't actually used.
+        a.writesoln(self.data, verbose=a.verbose, silent=a.silent,
+                    solncmd=solncmd, solnfile=a.solnfile, solnfmt=a.solnfmt,
+                    onlylastsoln=a.onlylastsoln,
+                    multipleattempts=a.multipleattempts,
+                    solntemplatedoc=a.solntemplatedoc,
+                    solntemplatestudent=a.solntemplatestudent,
+                    solntemplatesolnsattempt=a.solntemplatesolnsattempt,
+                    solntemplatesolnswrapper=a.solntemplatesolnswrapper,
+                    solntemplatesolnsingle=a.solntemplatesolnsingle,
+                    solntemplatesolnsingleinfo=a.solntemplatesolnsingleinfo,
+                    solntemplatesolnmultiwrapper=a.solntemplatesolnmultiwrapper,
+                    solntemplatesolnmultiwrapperinfo=a.solntemplatesolnmultiwrapperinfo,
+                    solntemplatesolnmulti=a.solntemplatesolnmulti,
+                    createdfiles=self.createdfiles,
+                    logfile=os.path.join(_logdir(a), 'solutions.log'))
+
+    def save(self):
+        a = self.a
+        _save_data(self.data, a.randassigndatafile, a.randassigndatafilefmt)
+
+    def finish(self):
+        '''
+        Merge the results of the run into the data file, write solutions, and
+        save.  All of this is done while holding the data lock, so that the
+        solutions always correspond to the saved data.
+        '''
+        self.closesink()
+        self.makebundle()
+        with self.datalock:
+            with self.tracer.span('merge data'):
+                self.merge()
+            self.progress.phase('solutions')
+            with self.tracer.span('solutions'):
+                self.writesoln(self.a.solncmd)
+            self.progress.phase('save')
+            with self.tracer.span('save data'):
+                self.save()
+        self.commit()
+        self.progress.phase('done')
+
+
+
+
+class _BuildSlot(object):
+    '''
+    Location where assignments are built, along with the commands and files
+    needed for building there.
+
+    By default, this is the document directory.  If ``builddir`` is given,
+    LaTeX and PythonTeX are run there instead.  The build directory gets its
+    own name, attempt, and message files, while everything else is still found
+    in the document directory via ``TEXINPUTS``.
+
+    With ``injection`` "cmdline", the name and attempt are instead defined on
+    the LaTeX command line.  Several slots may then share the document
+    directory, each with its own job name and message directory.
+    '''
+    def __init__(self, a, builddir=None, index=1):
+        # Track for the slot in traces
+        self.index = index
+        self.texcmd = a.texcmd
+        self.pythontexcmd = a.pythontexcmd
+        self.injection = a.injection
+        if a.injection == 'file':
+            self.namefile = a.namefile
+            self.attemptfile = a.attemptfile
+        else:
+            self.namefile = None
+            self.attemptfile = None
+        self.msgfilepattern = a.msgfilepattern
+        # Whether the document directory may be shared with other slots
+        self.shared = builddir is None and a.injection == 'cmdline'
+        stem = a.texfile.rsplit('.', 1)[0]
+        self.jobname = '{0}-{1}'.format(stem, index) if self.shared else stem
+        self.pdffile = '{0}.{1}'.format(self.jobname, 'pdf')
+        self.pytxcodefile = '{0}.{1}'.format(self.jobname, 'pytxcode')
+        # Whether the temp files that PythonTeX needs already exist
+        self.primed = False
+        # Student and attempt for the next assignment
+        self.student = None
+        self.attempt = None
+
+        # Whether the build directory is used only for this run
+        self.private = builddir is not None
+        if builddir is None:
+            self.dir = a.texdir
+            self.env = None
+        else:
+            self.dir = builddir
+            texdir = a.texdir
+            env = os.environ.copy()
+            # The trailing separator keeps the default search path
+            env['TEXINPUTS'] = os.pathsep.join(['.', texdir, env.get('TEXINPUTS', '')])
+            if not env['TEXINPUTS'].endswith(os.pathsep):
+                env['TEXINPUTS'] += os.pathsep
+            env['RANDASSIGN_MSGDIR'] = builddir
+            self.env = env
+            self.texcmd = self.texcmd[:-1] + [os.path.relpath(os.path.join(texdir, self.texcmd[-1]), builddir)]
+            self.pythontexcmd = self.pythontexcmd[:-1] + [a.texfile.rsplit('.', 1)[0]]
+            for f in (self.namefile, self.attemptfile):
+                if f is not None and os.path.dirname(f):
+                    fdir = os.path.join(builddir, os.path.dirname(f))
+                    if not os.path.isdir(fdir):
+                        os.makedirs(fdir)
+        if self.namefile is not None:
+            self.namefile = os.path.join(self.dir, self.namefile)
+        if self.attemptfile is not None:
+            self.attemptfile = os.path.join(self.dir, self.attemptfile)
+        self.pdffile = os.path.join(self.dir, self.pdffile)
+        self.pytxcodefile = os.path.join(self.dir, self.pytxcodefile)
+
+        if self.shared:
+            # PythonTeX accepts the job name in place of the tex file
+            self.pythontexcmd = self.pythontexcmd[:-1] + [self.jobname]
+            self.msgdir = os.path.join(a.randassigndir, 'build', self.jobname)
+            if not os.path.isdir(self.msgdir):
+                os.makedirs(self.msgdir)
+            env = os.environ.copy()
+            env['RANDASSIGN_MSGDIR'] = self.msgdir
+            self.env = env
+        else:
+            self.msgdir = self.dir
+
+        # With `selectiverun`, sessions that use RandAssign depend on a token
+        # file that changes for each build, so that PythonTeX reruns them
+        # while reusing the output of all other sessions
+        if a.selectiverun:
+            self.tokenfile = os.path.join(self.msgdir, '_randassign.token')
+            self.tokens = 0
+            self.tokenmtime = None
+            env = (self.env or os.environ).copy()
+            env['RANDASSIGN_TOKENFILE'] = self.tokenfile
+            self.env = env
+        else:
+            self.tokenfile = None
+
+    def environ(self, seed=None):
+        '''
+        Environment for running commands, with the student name and attempt
+        and an optional random seed for ``RandAssign``.  None means the
+        current environment.
+        '''
+        if seed is None and self.student is None:
+            return self.env
+        env = (self.env or os.environ).copy()
+        if self.student is not None:
+            env['RANDASSIGN_NAME'] = self.student
+            if self.attempt is not None:
+                env['RANDASSIGN_ATTEMPT'] = str(self.attempt)
+        if seed is not None:
+            env['RANDASSIGN_SEED'] = seed
+        return env
+
+    def commands(self):
+        '''
+        Commands for building the next assignment, as (label, command) pairs.
+        '''
+        # For the first assignment, we need to run tex, then pythontex, then
+        # tex again to produce the final pdf.  For subsequent assignments, the
+        # first tex run may be omitted, since the temp files that pythontex
+        # needs will already exist, and a following tex run will pick up the
+        # modified namefile and attemptfile for the final pdf.
+        texcmd = self.texcmd
+        if self.injection == 'cmdline':
+            defs = '\\def\\randassignname{{{0}}}'.format(self.student)
+            if self.attempt is not None:
+                defs += '\\def\\randassignattempt{{{0}}}'.format(self.attempt)
+            texfile = texcmd[-1].replace(os.sep, '/')
+            texcmd = texcmd[:-1] + ['-jobname={0}'.format(self.jobname), '{0}\\input{{{1}}}'.format(defs, texfile)]
+        if not self.primed:
+            return [('prime', texcmd), ('pythontex', self.pythontexcmd), ('tex', texcmd)]
+        return [('pythontex', self.pythontexcmd), ('tex', texcmd)]
+
+    def texstate(self):
+        '''
+        Hash of the auxiliary files that LaTeX writes and reads back on the
+        next run, and of the PythonTeX output files.  If a LaTeX run leaves
+        this unchanged, another run would give the same result.
+        '''
+        h = hashlib.sha1()
+        stem = self.pytxcodefile.rsplit('.', 1)[0]
+        # Other slots in a shared directory have their own job names
+        pattern = '{0}.aux'.format(self.jobname) if self.shared else '*.aux'
+        files = [os.path.join(self.dir, f) for f in sorted(fnmatch.filter(os.listdir(self.dir), pattern))]
+        files.extend('{0}.{1}'.format(stem, ext) for ext in ('toc', 'lof', 'lot', 'out'))
+        for f in files:
+            if os.path.isfile(f):
+                h.update(f.encode('utf8'))
+                with open(f, 'rb') as fp:
+                    h.update(fp.read())
+        # PythonTeX output only changes when PythonTeX runs, so its size and
+        # modification time are enough
+        outputdir = os.path.join(os.path.dirname(stem), 'pythontex-files-{0}'.format(os.path.basename(stem)))
+        if os.path.isdir(outputdir):
+            for root, dirs, fnames in os.walk(outputdir):
+                dirs.sort()
+                for fname in sorted(fnames):
+                    st = os.stat(os.path.join(root, fname))
+                    h.update('{0}:{1}:{2}'.format(os.path.join(root, fname), st.st_size, st.st_mtime).encode('utf8'))
+        return h.hexdigest()
+
+    def sessions(self):
+        '''
+        Count the PythonTeX sessions in the code file created by the last
+        LaTeX run.
+        '''
+        return _count_sessions(self.pytxcodefile)
+
+    def write(self, student, attempt):
+        '''
+        Write the name and attempt files (and the token file, with
+        ``selectiverun``) for the next assignment, and remove any existing
+        message files.
+        '''
+        # Removing message files ensures that any such files in the future
+        # constitute actual messages, rather than leftovers from previous runs
+        for f in fnmatch.filter(os.listdir(self.msgdir), self.msgfilepattern):
+            os.remove(os.path.join(self.msgdir, f))
+        self.student = student
+        self.attempt = attempt
+
+        if self.namefile is not None:
+            with open(self.namefile, 'w', encoding='utf8') as f:
+                f.write('{0}\\endinput\n'.format(student))
+
+        if attempt is not None and self.attemptfile is not None:
+            with open(self.attemptfile, 'w', encoding='utf8') as f:
+                f.write('{0}\\endinput\n'.format(attempt))
+
+        if self.tokenfile is not None:
+            self.tokens += 1
+            with open(self.tokenfile, 'w', encoding='utf8') as f:
+                f.write('{0}\n{1}\n{2}\n'.format(student, attempt, self.tokens))
+            # PythonTeX compares modification times, which may have a
+            # resolution of a second or more
+            mtime = os.stat(self.tokenfile).st_mtime
+            if self.tokenmtime is not None and mtime <= self.tokenmtime:
+                mtime = self.tokenmtime + 1
+                os.utime(self.tokenfile, (mtime, mtime))
+            self.tokenmtime = mtime
+
+    def solutions(self):
+        '''
+        Load the solutions from the message files created by the last build.
+        '''
         msgs = []
-        for fname in fnmatch.filter(os.listdir('.'), msgfilepattern):
+        for fname in fnmatch.filter(os.listdir(self.msgdir), self.msgfilepattern):
             try:
-                with open(fname, encoding='utf8') as f:
+                with open(os.path.join(self.msgdir, fname), encoding='utf8') as f:
                     m = json.load(f)
                 msgs.append(m)
                 assert m['type'] == 'randassign.solutions'
@@ -714,29 +2416,367 @@ def _run(data, createdfiles, students, students_raw, student_raw_str,
         if all(m['format'] == 'soln' for m in msgs):
             newsoln = [m['solutions'] for m in msgs]
         elif all(m['format'] == 'addsoln' for m in msgs):
-            newsoln = sorted((m_i for m_i in m['solutions'] for m in msgs), key=lambda m_i: m_i['number'])
+            newsoln = sorted((m_i for m in msgs for m_i in m['solutions']), key=lambda m_i: m_i['number'])
         else:
             raise RuntimeError('Mixing messages in "soln" and "addsoln" format is not allowed')
+        return newsoln
 
-        data[student_raw_str]['solutions'].append(newsoln)
 
-        # Name files using a sanitized form of the raw student name
-        if multipleattempts:
-            newfile = os.path.join(assigndir, '{0}_{1}.pdf'.format(student_raw_str.replace('"', '').replace('.', ''), attempt))
+
+
+def _count_sessions(pytxcodefile):
+    '''
+    Count the PythonTeX sessions in a PythonTeX code file.  Each combination
+    of family, session, and restart is run as a separate process.  Families
+    that are only highlighted by Pygments run no code, and are not counted.
+    '''
+    sessions = set()
+    with open(pytxcodefile, encoding='utf8') as f:
+        for line in f:
+            if line.startswith('=>PYTHONTEX#'):
+                family, session, restart = line.split('#')[1:4]
+                if not family.startswith('PYG'):
+                    sessions.add((family, session, restart))
+    return max(1, len(sessions))
+
+
+def _set_pythontex_rerun(cmd, rerun):
+    '''
+    Return a copy of the PythonTeX command ``cmd`` that reruns sessions
+    according to ``rerun``, replacing any rerun option already present.
+    '''
+    args = []
+    skip = False
+    for arg in cmd[1:-1]:
+        if skip:
+            skip = False
+        elif arg == '--rerun':
+            skip = True
+        elif not arg.startswith('--rerun='):
+            args.append(arg)
+    return [cmd[0]] + args + ['--rerun', rerun, cmd[-1]]
+
+
+def _set_pythontex_jobs(cmd, jobs):
+    '''
+    Return a copy of the PythonTeX command ``cmd`` that runs ``jobs`` jobs,
+    replacing any jobs option already present.
+    '''
+    args = []
+    skip = False
+    for arg in cmd[1:-1]:
+        if skip:
+            skip = False
+        elif arg in ('--jobs', '-j'):
+            skip = True
+        elif not (arg.startswith('--jobs=') or (arg.startswith('-j') and arg[2:].isdigit())):
+            args.append(arg)
+    return [cmd[0]] + args + ['--jobs', str(jobs), cmd[-1]]
+
+
+
+
+def _sanitize(student_raw_str):
+    '''
+    Sanitized form of a raw student name, for use in file names.
+    '''
+    return student_raw_str.replace('"', '').replace('.', '')
+
+
+_assignlayouts = ('flat', 'letter', 'attempt', 'hash')
+
+
+def _assignname(student_raw_str, attempt, assignlayout='flat'):
+    '''
+    Path of an assignment relative to the assigndir, or its entry name in an
+    archive, with "/" as the separator.
+    '''
+    if attempt is None:
+        name = '{0}.pdf'.format(_sanitize(student_raw_str))
+    else:
+        name = '{0}_{1}.pdf'.format(_sanitize(student_raw_str), attempt)
+    if hasattr(assignlayout, '__call__'):
+        subdir = assignlayout(student_raw_str, attempt)
+    elif assignlayout == 'flat':
+        subdir = None
+    elif assignlayout == 'letter':
+        subdir = name[0].upper() if name[0].isalnum() else '_'
+    elif assignlayout == 'attempt':
+        subdir = None if attempt is None else 'attempt_{0}'.format(attempt)
+    elif assignlayout == 'hash':
+        # Two hex digits give 256 evenly filled subdirectories
+        subdir = hashlib.md5(student_raw_str.encode('utf8')).hexdigest()[:2]
+    else:
+        raise ValueError('Invalid assignment layout "{0}"'.format(assignlayout))
+    if subdir:
+        return '{0}/{1}'.format(subdir.replace(os.sep, '/').strip('/'), name)
+    return name
+
+
+def assignpath(student, attempt=None, assigndir='randassign/assignments',
+               assignlayout='flat'):
+    '''
+    Return the path of the assignment for ``student`` (the raw name, as in
+    the student file) and ``attempt``, without searching ``assigndir``.  The
+    default ``assigndir`` is the default for ``make()``, relative to the
+    LaTeX file's directory.  ``attempt`` should be None if
+    ``multipleattempts`` is False.  ``assignlayout`` must be the same as for
+    ``make()``.
+
+    With ``assignsink`` "zip" or "tar", the name of the entry in the archive
+    is the returned path relative to ``assigndir``.
+    '''
+    return os.path.join(assigndir, *_assignname(student, attempt, assignlayout).split('/'))
+
+
+def _logdir(a):
+    '''
+    Directory for the logs of all commands.
+    '''
+    return os.path.join(a.randassigndir, 'logs')
+
+
+
+
+def _newseed():
+    '''
+    Create a fresh random seed for retrying a failed build.
+    '''
+    return binascii.hexlify(os.urandom(8)).decode('ascii')
+
+
+
+
+class BuildError(subprocess.CalledProcessError):
+    '''
+    A LaTeX, PythonTeX, or solution command failed.
+
+    ``output`` is only the last part of the output, as bytes, and ``tail``
+    is the same as text.  ``errors`` is a list of the error lines found in
+    the complete output.  The complete output is in ``logfile``, if there is
+    one.  The message lists the error lines that are not already in
+    ``tail``, since the tail is shown along with the error.
+    '''
+    def __init__(self, returncode, cmd, output=None, errors=None, logfile=None):
+        subprocess.CalledProcessError.__init__(self, returncode, cmd, output)
+        self.tail = (output or b'').decode('utf8', 'replace')
+        self.errors = errors or []
+        self.logfile = logfile
+
+    def __str__(self):
+        msg = subprocess.CalledProcessError.__str__(self)
+        tail = set(line.rstrip() for line in self.tail.splitlines())
+        errors = [e for e in self.errors if e not in tail]
+        if errors:
+            msg += '\n' + '\n'.join(errors)
+        if self.logfile:
+            msg += '\nSee log "{0}"'.format(self.logfile)
+        return msg
+
+
+
+
+class _OutputCapture(object):
+    '''
+    Stream the output of a command to a log file, keeping only the last
+    ``taillines`` lines and up to ``maxerrors`` error lines in memory.
+    '''
+    # LaTeX errors start with "!" and are followed by the line number; Python
+    # and PythonTeX errors mention "Error"
+    error_re = re.compile(r'^(?:! |l\.\d+ )|Error|Traceback')
+
+    def __init__(self, cmd, logfile=None, taillines=40, maxerrors=20):
+        self.cmd = cmd
+        self.logfile = logfile
+        self.tail = collections.deque(maxlen=taillines)
+        self.errors = []
+        self.maxerrors = maxerrors
+        if logfile is None:
+            self.log = None
         else:
-            if len(data[student]['solutions']) > 1:
-                raise RuntimeError('Although "multipleattempts" is False, there are multiple solutions for {0}'.format(student))
-            newfile = os.path.join(assigndir, '{0}.pdf'.format(student_raw_str.replace('"', '').replace('.', '')))
-        # Need `abspath()` to ensure functioning
-        createdfiles.append(os.path.abspath(newfile))
-        if not os.path.isfile(newfile):
-            shutil.copy(pdffile, newfile)
+            self.log = open(logfile, 'ab')
+            self.log.write('$ {0}\n'.format(' '.join(cmd)).encode('utf8'))
+
+    def write(self, line):
+        '''
+        Process a line of output, as bytes.
+        '''
+        if self.log is not None:
+            self.log.write(line)
+        self.tail.append(line)
+        if len(self.errors) < self.maxerrors:
+            text = line.decode('utf8', 'replace').rstrip()
+            if self.error_re.search(text):
+                self.errors.append(text)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def error(self, returncode):
+        '''
+        Create a ``BuildError`` for a failed command.
+        '''
+        return BuildError(returncode, self.cmd, b''.join(self.tail), self.errors, self.logfile)
+
+
+
+
+def _show_tail(e, silent):
+    '''
+    Print the last part of the output of a failed command, if ``e`` is a
+    ``BuildError``, unless ``silent``.  This is only done once the command has
+    finally failed, and not for tries that are retried.
+    '''
+    if not silent and isinstance(e, BuildError):
+        print(e.tail, file=sys.stderr)
+
+
+
+
+def _call(cmd, verbose, cwd=None, env=None, logfile=None, silent=True):
+    '''
+    Run a LaTeX, PythonTeX, or solution command, appending its output to
+    ``logfile``.  Only the last part of the output is kept in memory.  If the
+    command fails, a ``BuildError`` is raised, and unless ``silent``, the last
+    part of the output is printed.
+    '''
+    if verbose:
+        if logfile is None:
+            print('Running command {0}'.format(cmd))
         else:
-            raise RuntimeError('The assignment "{0}" already exists; this may be due to a previous error, or two randassign files in the same directory (in which case, consider setting "randassigndir" to a custom value)'.format(newfile))
+            print('Running command {0} (log "{1}")'.format(cmd, logfile))
+    capture = _OutputCapture(cmd, logfile)
+    try:
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        for line in iter(proc.stdout.readline, b''):
+            capture.write(line)
+        proc.stdout.close()
+        returncode = proc.wait()
+    finally:
+        capture.close()
+    if returncode:
+        e = capture.error(returncode)
+        _show_tail(e, silent)
+        raise e
+
+
+def _rotate_log(logfile, backups=2):
+    '''
+    Keep up to ``backups`` previous versions of a log file, as
+    ``<logfile>.1``, ``<logfile>.2``, etc.
+    '''
+    for n in range(backups, 0, -1):
+        src = logfile if n == 1 else '{0}.{1}'.format(logfile, n-1)
+        if os.path.isfile(src):
+            dst = '{0}.{1}'.format(logfile, n)
+            if os.path.isfile(dst):
+                os.remove(dst)
+            os.rename(src, dst)
 
-    if not silent:
-        print(' '*40 + '\r', end='')
-        sys.stdout.flush()
+
+
+
+_formatter = string.Formatter()
+
+
+class _SolnTemplate(object):
+    '''
+    Solution template, compiled once for rendering many solutions.
+
+    Templates are ``str.format()`` strings in which ``{solution}`` is the
+    nested content.  When ``{solution}`` appears exactly once, the template is
+    split around it, so that the text before and after the content is
+    rendered on its own, and the nested content is appended to the output in
+    between rather than being joined into a string first.  Text without any
+    fields is rendered once, at compile time.  Other templates are rendered
+    with ``str.format()`` after the content has been joined.
+
+    Output is appended to a list of strings, ``out``.  Nested content is
+    rendered between ``begin()`` and ``end()``, while ``fill()`` renders a
+    list of values as the content.
+    '''
+    def __init__(self, template):
+        self.template = template
+        before = []
+        after = None
+        split = True
+        for literal, field, spec, conversion in _formatter.parse(template):
+            current = before if after is None else after
+            current.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is None:
+                continue
+            root = field.split('.', 1)[0].split('[', 1)[0]
+            if field == 'solution':
+                if after is not None or spec or conversion:
+                    split = False
+                after = []
+            elif root == 'solution':
+                split = False
+            else:
+                current.append('{{{0}{1}{2}}}'.format(field,
+                                                      '' if conversion is None else '!' + conversion,
+                                                      ':' + spec if spec else ''))
+        if after is None:
+            after = []
+        self.split = split
+        self.before, self.beforefields = self._compile(''.join(before))
+        self.after, self.afterfields = self._compile(''.join(after))
+        # Whether the text around the content is fixed, in which case the
+        # text between consecutive renderings is as well
+        self.constant = split and not self.beforefields and not self.afterfields
+        self.between = self.after + self.before if self.constant else None
+
+    @staticmethod
+    def _compile(template):
+        '''
+        Return the template and whether it has fields, or if not, the
+        rendered text.
+        '''
+        if any(field is not None for _, field, _, _ in _formatter.parse(template)):
+            return template, True
+        return template.format(), False
+
+    def render(self, out, **fields):
+        self.end(out, self.begin(out, **fields))
+
+    def begin(self, out, **fields):
+        '''
+        Start rendering the template, returning a state to pass to ``end()``
+        once the content has been appended to ``out``.
+        '''
+        if self.split:
+            out.append(self.before.format(**fields) if self.beforefields else self.before)
+        return (len(out), fields)
+
+    def end(self, out, state):
+        start, fields = state
+        if self.split:
+            out.append(self.after.format(**fields) if self.afterfields else self.after)
+        else:
+            content = ''.join(out[start:])
+            del out[start:]
+            out.append(self.template.format(solution=content, **fields))
+
+    def fill(self, out, solutions, **fields):
+        '''
+        Render the template once for each value in ``solutions`` as the
+        content, with the same ``fields``.
+        '''
+        # Consecutive renderings share the text between the values, so they
+        # can be rendered with a single join.  `str()` gives the same result
+        # as `format()` with an empty format specification.
+        if self.constant:
+            out.append(self.before + self.between.join(map(str, solutions)) + self.after)
+        elif self.split:
+            before = self.before.format(**fields) if self.beforefields else self.before
+            after = self.after.format(**fields) if self.afterfields else self.after
+            out.append(before + (after + before).join(map(str, solutions)) + after)
+        else:
+            for solution in solutions:
+                out.append(self.template.format(solution=solution, **fields))
 
 
 
@@ -753,7 +2793,7 @@ def _writesoln(data, verbose=None, silent=None,
                solntemplatesolnmultiwrapper=None,
                solntemplatesolnmultiwrapperinfo=None,
                solntemplatesolnmulti=None,
-               createdfiles=None):
+               createdfiles=None, logfile=None):
 
     '''
     Write solutions in a specified format, using custom templates if supplied.
@@ -770,6 +2810,8 @@ def _writesoln(data, verbose=None, silent=None,
     Thus, ``writesoln()`` is always called in the same manner (that need
     not be customized), regardless of whether a custom function is in use and
     without making the creation of custom functions needlessly complex.
+
+    The output of ``solncmd`` is saved in ``logfile``.
     '''
 
     if solnfmt not in ('tex', 'md', 'markdown'):
@@ -796,78 +2838,82 @@ def _writesoln(data, verbose=None, silent=None,
         solntemplatesolnmultiwrapperinfo = solntemplatesolnmultiwrapperinfo or _solntemplatesolnmultiwrapperinfo_md
         solntemplatesolnmulti = solntemplatesolnmulti or _solntemplatesolnmulti_md
 
-    allsolutions = []
+    t_doc = _SolnTemplate(solntemplatedoc)
+    t_student = _SolnTemplate(solntemplatestudent)
+    t_attempt = _SolnTemplate(solntemplatesolnsattempt)
+    t_wrapper = _SolnTemplate(solntemplatesolnswrapper)
+    t_single = _SolnTemplate(solntemplatesolnsingle)
+    t_singleinfo = _SolnTemplate(solntemplatesolnsingleinfo)
+    t_multiwrapper = _SolnTemplate(solntemplatesolnmultiwrapper)
+    t_multiwrapperinfo = _SolnTemplate(solntemplatesolnmultiwrapperinfo)
+    t_multi = _SolnTemplate(solntemplatesolnmulti)
+
+    # Everything is rendered into a single list of strings, which is joined
+    # once at the end, so that nested solutions never need to be joined
+    # separately.  Nothing is written if there is an error.
+    out = []
+    append = out.append
+    doc = t_doc.begin(out)
     for student_raw_str in sorted((k for k in data), key=lambda x: x.split(',')[0]):
+        solutions = data[student_raw_str]['solutions']
+        if not solutions:
+            # Students whose builds have only failed, or whose attempts are
+            # all prebuilt, have no solutions yet
+            continue
         if onlylastsoln:
-            solns = [data[student_raw_str]['solutions'][-1]]
-            attempts = [len(data[student_raw_str]['solutions'])]
+            solns = [solutions[-1]]
+            attempts = [len(solutions)]
         else:
-            solns = data[student_raw_str]['solutions']
-            attempts = [n for n in range(1, len(data[student_raw_str]['solutions'])+1)]
+            solns = solutions
+            attempts = range(1, len(solutions)+1)
         if not multipleattempts:
-            if len(data[student_raw_str]['solutions']) > 1:
-                raise RuntimeError('Although "multipleattempts" is False, there are multiple solutions for {0}'.format(student))
+            if len(solutions) > 1:
+                raise RuntimeError('Although "multipleattempts" is False, there are multiple solutions for {0}'.format(student_raw_str))
             else:
                 attempts = [None]
 
-        studentsolutions = []
+        student = t_student.begin(out, name=student_raw_str)
         for attempt, solnset in zip(attempts, solns):
-            solution = []
-            wrapper = True
-            for n, s in enumerate(solnset):
+            if attempt is not None:
+                t_attempt.render(out, attempt=attempt)
+            # Solutions in "addsoln" format are wrapped, while "soln" format
+            # solutions are used as is
+            wrapper = not any(isinstance(s, str) for s in solnset)
+            if wrapper:
+                wrapped = t_wrapper.begin(out)
+            for s in solnset:
                 if isinstance(s, str):
-                    solution.append(s)
-                    wrapper = False
+                    append(s)
                 elif isinstance(s, dict):
                     if len(s['solution']) == 1:
                         if s['info']:
-                            solution.append(solntemplatesolnsingleinfo.format(number=s['number'], info=s['info'], solution=s['solution'][0]))
+                            t_singleinfo.fill(out, s['solution'], number=s['number'], info=s['info'])
                         else:
-                            solution.append(solntemplatesolnsingle.format(number=s['number'], solution=s['solution'][0]))
+                            t_single.fill(out, s['solution'], number=s['number'])
                     else:
                         if s['info']:
-                            solution.append(solntemplatesolnmultiwrapperinfo.format(number=s['number'], info=s['info'], solution=''.join(solntemplatesolnmulti.format(solution=x) for x in s['solution'])))
+                            t = t_multiwrapperinfo
+                            multi = t.begin(out, number=s['number'], info=s['info'])
                         else:
-                            solution.append(solntemplatesolnmultiwrapper.format(number=s['number'], solution=''.join(solntemplatesolnmulti.format(solution=x) for x in s['solution'])))
+                            t = t_multiwrapper
+                            multi = t.begin(out, number=s['number'])
+                        t_multi.fill(out, s['solution'])
+                        t.end(out, multi)
                 else:
                     raise RuntimeError('Invalid solution format')
-
             if wrapper:
-                solution = solntemplatesolnswrapper.format(solution=''.join(solution))
-            else:
-                solution = ''.join(solution)
-            if attempt is not None:
-                solution = solntemplatesolnsattempt.format(attempt=attempt) + solution
-
-            studentsolutions.append(solution)
-
-        allsolutions.append(solntemplatestudent.format(name=student_raw_str, solution=''.join(studentsolutions)))
+                t_wrapper.end(out, wrapped)
+        t_student.end(out, student)
+    t_doc.end(out, doc)
 
     with open(solnfile, 'w', encoding='utf8') as f:
-        f.write(solntemplatedoc.format(solution=''.join(allsolutions)))
+        f.write(''.join(out))
 
     if solncmd:
-        cwd = os.getcwd()
         solndir = os.path.split(solnfile)[0]
-        if solndir:
-            os.chdir(solndir)
-        if verbose:
-            print('Running command {0}'.format(solncmd))
-            subprocess.call(solncmd)
-        else:
-            if not silent:
-                # Final progress message needs to overwrite all previous
-                print('Generating solutions\r', end='')
-                sys.stdout.flush()
-            try:
-                subprocess.check_output(solncmd)
-            except subprocess.CalledProcessError as e:
-                print(e.output.decode(sys.getdefaultencoding()), file=sys.stderr)
-                raise
-            if not silent:
-                print(' '*40 + '\r', end='')
-                sys.stdout.flush()
-        os.chdir(cwd)
+        if logfile is not None:
+            _rotate_log(logfile)
+        _call(solncmd, verbose, cwd=solndir or None, logfile=logfile, silent=silent)
 
 
 
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015, Geoffrey M. Poore
+# All rights reserved.
+#
+# Licensed under the BSD 3-Clause License:
+# http://opensource.org/licenses/BSD-3-Clause
+#
+
+
+'''
+Progress tracking for ``make()``.
+
+Each change in progress is passed to callbacks as a ``ProgressSnapshot``.  A
+callback may be supplied via ``make(progress=<callback>)``.  By default, the
+``randassign`` utility renders progress on the terminal via
+``TerminalProgress``.  ``ProgressPoller`` keeps the latest snapshot for
+polling, for example from another thread.
+'''
+
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+
+import sys
+import time
+import threading
+import collections
+
+
+
+
+# State of a run at a point in time
+#
+# `phase` is one of "load", "build", "bundle", "solutions", "save", or "done".  `total`,
+# `completed`, and `failed` count students, and `inflight` maps the
+# (student, attempt) pairs currently being built to the current step
+# ("prime", "pythontex", or "tex"); the attempt is None without
+# `multipleattempts`, and the pairs differ when several attempts for a student
+# are prebuilt simultaneously.  `throughput` is in students per second and `eta` is the
+# estimated remaining time for the build phase in seconds; both are None
+# until they can be estimated.  `elapsed` is the time since the start of the
+# run, and `phase_elapsed` the time since the start of the current phase.
+ProgressSnapshot = collections.namedtuple('ProgressSnapshot',
+                                          ['phase', 'total', 'completed',
+                                           'failed', 'inflight', 'throughput',
+                                           'eta', 'elapsed', 'phase_elapsed'])
+
+
+
+
+class Progress(object):
+    '''
+    Track the progress of a run, passing a ``ProgressSnapshot`` to each
+    callback after every change.
+
+    Throughput is estimated from the last ``window`` completed students, so
+    that it follows changes in build times and reflects simultaneous builds.
+    Safe for use from multiple threads.
+    '''
+    def __init__(self, callbacks=None, window=10):
+        self.callbacks = list(callbacks or [])
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.phase_name = None
+        self.phase_start = self.start_time
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.inflight = collections.OrderedDict()
+        self.finish_times = collections.deque(maxlen=window)
+
+    def phase(self, name, total=None):
+        '''
+        Start a new phase of the run.
+        '''
+        with self.lock:
+            self.phase_name = name
+            self.phase_start = time.time()
+            if total is not None:
+                self.total = total
+                self.completed = 0
+                self.failed = 0
+                self.inflight.clear()
+                self.finish_times.clear()
+                self.finish_times.append(self.phase_start)
+            snapshot = self._snapshot()
+        self._notify(snapshot)
+
+    def step(self, student, step, attempt=None):
+        '''
+        Record that ``attempt`` for ``student`` is being built and is at
+        ``step``.
+        '''
+        with self.lock:
+            self.inflight[(student, attempt)] = step
+            snapshot = self._snapshot()
+        self._notify(snapshot)
+
+    def finish(self, student, failed=False, attempt=None):
+        '''
+        Record that the build of ``attempt`` for ``student`` is complete.
+        '''
+        with self.lock:
+            self.inflight.pop((student, attempt), None)
+            self.completed += 1
+            if failed:
+                self.failed += 1
+            self.finish_times.append(time.time())
+            snapshot = self._snapshot()
+        self._notify(snapshot)
+
+    def snapshot(self):
+        with self.lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        now = time.time()
+        throughput = None
+        eta = None
+        # The first entry is the start of the build phase or the oldest
+        # completion still in the window
+        if len(self.finish_times) > 1:
+            span = self.finish_times[-1] - self.finish_times[0]
+            if span > 0:
+                throughput = (len(self.finish_times) - 1) / span
+                eta = (self.total - self.completed) / throughput
+        return ProgressSnapshot(self.phase_name, self.total, self.completed,
+                                self.failed, dict(self.inflight), throughput,
+                                eta, now - self.start_time,
+                                now - self.phase_start)
+
+    def _notify(self, snapshot):
+        for callback in self.callbacks:
+            callback(snapshot)
+
+
+
+
+class ProgressPoller(object):
+    '''
+    Progress callback that keeps the latest snapshot, for polling::
+
+        poller = ProgressPoller()
+        make(texfile='<tex_file>', progress=poller)
+        # Elsewhere:  poller.snapshot
+    '''
+    def __init__(self):
+        self.snapshot = None
+
+    def __call__(self, snapshot):
+        self.snapshot = snapshot
+
+
+
+
+class TerminalProgress(object):
+    '''
+    Progress callback that renders a single, continually updated line on the
+    terminal.
+    '''
+    messages = {'load': 'Loading data',
+                'bundle': 'Generating print bundle',
+                'solutions': 'Generating solutions',
+                'save': 'Saving data'}
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+        self.width = 0
+
+    def __call__(self, snapshot):
+        if snapshot.phase == 'build':
+            line = self.format_build(snapshot)
+        else:
+            line = self.messages.get(snapshot.phase, '')
+        with self.lock:
+            # Pad to overwrite all of the previous line
+            self.stream.write(line.ljust(self.width) + '\r')
+            self.stream.flush()
+            self.width = len(line) if line else 0
+
+    @staticmethod
+    def format_build(snapshot):
+        width = len(str(snapshot.total))
+        line = 'Generating assignments {0}/{1}'.format(str(snapshot.completed).rjust(width), snapshot.total)
+        details = []
+        if snapshot.inflight:
+            details.append('{0} in progress'.format(len(snapshot.inflight)))
+        if snapshot.failed:
+            details.append('{0} failed'.format(snapshot.failed))
+        if details:
+            line += ' ({0})'.format(', '.join(details))
+        if snapshot.throughput is not None:
+            minutes, seconds = divmod(int(round(snapshot.eta)), 60)
+            line += '  {0:.1f}/min  ETA {1}:{2:02d}'.format(snapshot.throughput*60, minutes, seconds)
+        return line
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015, Geoffrey M. Poore
+# All rights reserved.
+#
+# Licensed under the BSD 3-Clause License:
+# http://opensource.org/licenses/BSD-3-Clause
+#
+
+
+'''
+Local HTTP service that builds a new attempt for a single student on request,
+for example for make-up exams.
+'''
+
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+
+import os
+import sys
+if sys.version_info.major == 2:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    import Queue as queue
+else:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+    import queue
+import collections
+import contextlib
+import copy
+import json
+import shutil
+import threading
+import time
+from .make import (_process_args, _MakeRun, _BuildSlot, _make_builddir,
+                   _check_directory_structure, _load_data, _merge_data,
+                   _save_data, _load_students, _parsestudentfile,
+                   _parsestudentname, _rosterfile, _logdir, _rotate_log, _call)
+from .lock import FileLock
+from .progress import Progress
+
+
+
+
+class _Service(object):
+    '''
+    Builds assignments for one student at a time, using a pool of private
+    build directories that are primed when the service starts.
+
+    Each request gets its own ``_MakeRun``, so requests proceed exactly as
+    ``make(student=<student>)`` does, except that nothing needs to be loaded
+    or primed first.  Requests for different students are built
+    simultaneously, up to the size of the pool; requests for the same student
+    wait on each other, so that each gets the next attempt.  The new attempt
+    is merged into the data file and saved while holding the data lock,
+    before the request returns.  Solutions are regenerated in the background
+    afterward, so that the solution command does not add to the latency of
+    requests.
+    '''
+    def __init__(self, a, window=1000):
+        self.a = a
+        self.datafilelock = FileLock(a.randassigndatafile + '.lock', silent=a.silent)
+        # Requests wait on each other here, so that only waiting on other
+        # runs is reported
+        self.datathreadlock = threading.Lock()
+        if a.parsestudentfile is _parsestudentfile and a.parsestudentname is _parsestudentname:
+            self.rosterfile = _rosterfile(a)
+        else:
+            self.rosterfile = None
+        # Data file as last loaded or saved, with the modification time and
+        # size that identify it; it is only loaded again if another run has
+        # changed it
+        self.data = None
+        self.datastat = None
+        self.slots = []
+        self.pool = queue.Queue()
+        self.lock = threading.Lock()
+        self.studentlocks = collections.defaultdict(threading.Lock)
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.failed = 0
+        # Whether attempts have been added since the solutions were written
+        self.added = False
+        self.solutions_pending = threading.Event()
+        self.stopping = False
+        self.solutions_thread = None
+
+    def start(self):
+        '''
+        Load the data, and create and prime the pool of build directories.
+        '''
+        a = self.a
+        _check_directory_structure(a.randassigndir, a.solndir, a.assigndir, _logdir(a))
+        with self.datalock():
+            # Backups are only made once, as at the start of a run
+            self.data = _load_data(a.randassigndatafile, a.randassigndatafilefmt)
+            self.datastat = self._stat()
+        students = _load_students(None, a.studentfile, a.parsestudentfile, a.parsestudentname, self.rosterfile)[0]
+        logfile = os.path.abspath(os.path.join(_logdir(a), 'prime.log'))
+        _rotate_log(logfile)
+        for k in range(1, a.jobs+1):
+            slot = _BuildSlot(a, _make_builddir(a.randassigndir, a.scratchdir), index=k)
+            self.slots.append(slot)
+            # The name and attempt only need to exist for the first LaTeX run;
+            # each request writes its own before running PythonTeX
+            slot.write(students[0], 1 if a.multipleattempts else None)
+            _call(slot.commands()[0][1], a.verbose, cwd=slot.dir, env=slot.environ(), logfile=logfile, silent=a.silent)
+            slot.primed = True
+            self.pool.put(slot)
+        self.solutions_thread = threading.Thread(target=self._solutions_worker)
+        self.solutions_thread.daemon = True
+        self.solutions_thread.start()
+
+    def stop(self):
+        '''
+        Write any pending solutions, and remove the build directories.
+        '''
+        self.stopping = True
+        self.solutions_pending.set()
+        if self.solutions_thread is not None:
+            self.solutions_thread.join()
+        for slot in self.slots:
+            shutil.rmtree(slot.dir, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def datalock(self):
+        with self.datathreadlock:
+            with self.datafilelock:
+                yield
+
+    def _stat(self):
+        try:
+            st = os.stat(self.a.randassigndatafile)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _current_data(self):
+        '''
+        Return the data as it exists on disk.  Must be called while holding
+        ``datalock``.
+        '''
+        stat = self._stat()
+        if self.data is None or stat != self.datastat:
+            self.data = _load_data(self.a.randassigndatafile, self.a.randassigndatafilefmt, backup=False)
+            self.datastat = stat
+        return self.data
+
+    def build(self, student):
+        '''
+        Build a new attempt for ``student``, which is matched against the
+        student file as with ``make(student=<student>)``.  Return a
+        ``StudentResult``, with the latency of the request added to its
+        ``timings`` as ``request``.
+        '''
+        start = time.time()
+        a = self.a._replace(student=student)
+        run = _MakeRun(a)
+        # Requests are reported by the service rather than on the terminal
+        run.progress = Progress()
+        try:
+            s = _load_students(student, a.studentfile, a.parsestudentfile, a.parsestudentname, self.rosterfile)
+            run.students, run.students_raw, run.students_raw_str = s
+            student_raw_str = run.students_raw_str[0]
+            with self.lock:
+                studentlock = self.studentlocks[student_raw_str]
+            with studentlock:
+                with self.datalock():
+                    record = self._current_data().get(student_raw_str)
+                run.data = {}
+                if record is not None:
+                    run.data[student_raw_str] = copy.deepcopy(record)
+                if a.preflight:
+                    problems = run.preflight()
+                    if problems:
+                        raise RuntimeError('\n'.join(problems))
+                slot = self.pool.get()
+                try:
+                    result = run.build_student(slot, 0)
+                finally:
+                    self.pool.put(slot)
+                with self.datalock():
+                    try:
+                        current = self._current_data()
+                        self.data = _merge_data(current, run.data, run.added, run.history)
+                        _save_data(self.data, a.randassigndatafile, a.randassigndatafilefmt)
+                        self.datastat = self._stat()
+                    except:
+                        # The cached data may have been partially merged
+                        self.data = None
+                        raise
+                run.commit()
+        except:
+            run.rollback()
+            with self.lock:
+                self.requests += 1
+                self.failed += 1
+            raise
+        result.timings['request'] = time.time() - start
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(result.timings['request'])
+            self.added = True
+        self.solutions_pending.set()
+        return result
+
+    def _solutions_worker(self):
+        '''
+        Regenerate the solutions whenever attempts have been added, combining
+        the attempts from all requests completed in the meantime.
+        '''
+        while True:
+            self.solutions_pending.wait()
+            self.solutions_pending.clear()
+            with self.lock:
+                added = self.added
+                self.added = False
+            if added:
+                try:
+                    self.writesoln()
+                except Exception as e:
+                    if not self.a.silent:
+                        print('Failed to generate solutions:  {0}'.format(e), file=sys.stderr)
+            if self.stopping:
+                return
+
+    def writesoln(self):
+        '''
+        Write the solutions for the current data.  The solution command is
+        run after releasing the data lock, so that requests are not held up
+        while it runs.
+        '''
+        a = self.a
+        run = _MakeRun(a)
+        run.progress = Progress()
+        try:
+            with self.datalock():
+                run.data = self._current_data()
+                run.writesoln(None)
+            if a.solncmd:
+                logfile = os.path.abspath(os.path.join(_logdir(a), 'solutions.log'))
+                _rotate_log(logfile)
+                _call(a.solncmd, a.verbose, cwd=a.solndir or None, logfile=logfile, silent=a.silent)
+            run.commit()
+        except:
+            run.rollback()
+            raise
+
+    def stats(self):
+        '''
+        Summary of the requests handled so far, with latencies in seconds for
+        the most recent successful requests.
+        '''
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {'requests': self.requests, 'failed': self.failed,
+                     'pool': len(self.slots), 'idle': self.pool.qsize()}
+        if latencies:
+            def percentile(p):
+                return latencies[min(len(latencies)-1, int(p*len(latencies)))]
+            stats['latency'] = {'mean': sum(latencies)/len(latencies),
+                                'p50': percentile(0.5), 'p95': percentile(0.95),
+                                'max': latencies[-1]}
+        else:
+            stats['latency'] = None
+        return stats
+
+
+
+
+class _Handler(BaseHTTPRequestHandler):
+    '''
+    ``POST /assignments?student=<student>`` builds a new attempt, and returns
+    the assignment as JSON.  ``GET /stats`` returns ``_Service.stats()``.
+    '''
+    def do_GET(self):
+        if urlparse(self.path).path != '/stats':
+            self.reply(404, {'error': 'Not found'})
+            return
+        self.reply(200, self.server.service.stats())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/assignments':
+            self.reply(404, {'error': 'Not found'})
+            return
+        student = parse_qs(url.query).get('student', [None])[0]
+        if student is None:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                try:
+                    student = json.loads(self.rfile.read(length).decode('utf8')).get('student')
+                except (ValueError, AttributeError):
+                    pass
+        if not student:
+            self.reply(400, {'error': 'No student was specified'})
+            return
+        service = self.server.service
+        try:
+            r = service.build(student)
+        except Exception as e:
+            if not service.a.silent:
+                print('Failed to generate assignment for {0}:  {1}'.format(student, e), file=sys.stderr)
+            self.reply(500, {'error': str(e), 'logfile': getattr(e, 'logfile', None)})
+            return
+        if not service.a.silent:
+            print('Generated assignment for {0} (attempt {1}) in {2:.1f} s'.format(r.student, r.attempt, r.timings['request']))
+        self.reply(200, {'student': r.student, 'student_raw': r.student_raw,
+                         'attempt': r.attempt, 'assignment': r.assignment,
+                         'timings': r.timings, 'latency': r.timings['request']})
+
+    def reply(self, status, obj):
+        body = json.dumps(obj).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.service.a.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+
+
+def serve(**kwargs):
+    '''
+    Run a local HTTP service that builds a new attempt for a single student
+    on request, until interrupted with Ctrl+C.
+
+    Accepts the same keyword arguments as ``make()``, except ``cores``.
+    Assignments are built in a pool of ``jobs`` private build directories,
+    which are primed when the service starts, so each request only runs
+    PythonTeX and LaTeX.  The service listens on ``servehost`` (default
+    ``127.0.0.1``) and ``serveport`` (default 8000)::
+
+        POST /assignments?student=<student>
+
+    builds the next attempt for the student, saves it in the data file, and
+    returns JSON with ``student``, ``student_raw``, ``attempt``,
+    ``assignment`` (the path of the PDF), ``timings``, and ``latency`` (the
+    time for the request in seconds).  ``GET /stats`` returns the number of
+    requests and latency statistics.  Solutions are regenerated in the
+    background after requests.
+    '''
+    a = _process_args(kwargs)
+    if a.cores is not None:
+        raise RuntimeError('Option "cores" is not supported with "serve"; the pool has "jobs" build directories')
+    a = a._replace(serve=False, isolate=True, keepgoing=False,
+                   assignsink='dir', bundle=False, trace=None)
+    for k in ('namefile', 'attemptfile'):
+        if a.injection == 'file' and os.path.isabs(getattr(a, k)):
+            raise ValueError('Option "serve" requires a relative path for "{0}"; currently "{1}"'.format(k, getattr(a, k)))
+    service = _Service(a)
+    httpd = None
+    try:
+        service.start()
+        httpd = _Server((a.servehost, a.serveport), _Handler)
+        httpd.service = service
+        if not a.silent:
+            print('Serving assignments for {0} on http://{1}:{2}/ with {3} build slot(s) (Ctrl+C to stop)'.format(a.texfile, a.servehost, httpd.server_address[1], a.jobs))
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if httpd is not None:
+            httpd.server_close()
+        service.stop()
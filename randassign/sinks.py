@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015, Geoffrey M. Poore
+# All rights reserved.
+#
+# Licensed under the BSD 3-Clause License:
+# http://opensource.org/licenses/BSD-3-Clause
+#
+
+
+'''
+Archives that assignments are appended to as they are built, for
+``make(assignsink='zip')`` and ``make(assignsink='tar')``.
+'''
+
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+
+import os
+import sys
+if sys.version_info.major == 2:
+    from io import open
+import json
+import tarfile
+import threading
+import zipfile
+from .lock import FileLock
+
+
+
+
+class ArchiveSink(object):
+    '''
+    Archive to which assignments are appended during a run.
+
+    Appending only writes past the end of the existing entries, so the
+    archive can be restored after an error by truncating it to its original
+    entries and restoring the bytes that followed them (the zip central
+    directory, or the tar end-of-archive blocks), which are saved when the
+    archive is opened.  The archive is locked from ``open()`` until
+    ``commit()`` or ``rollback()``, so that simultaneous runs append to it in
+    turn.
+
+    A manifest listing the student, attempt, and entry name for each
+    assignment is kept alongside the archive, in ``<archive>.manifest.json``.
+    '''
+    def __init__(self, path, silent=False):
+        self.path = os.path.abspath(path)
+        self.manifestfile = self.path + '.manifest.json'
+        self.lock = threading.Lock()
+        self.filelock = FileLock(self.path + '.lock', silent=silent)
+        self.archive = None
+        self.created = False
+        self.offset = None
+        self.tail = None
+        self.names = None
+        self.manifest = None
+        self.added = []
+        self.closed = False
+        # Set if adding an entry fails, since the archive may then contain
+        # part of an entry and can only be rolled back
+        self.broken = False
+
+    def open(self):
+        self.filelock.acquire()
+        try:
+            if os.path.isfile(self.manifestfile):
+                with open(self.manifestfile, encoding='utf8') as f:
+                    self.manifest = json.load(f)
+            else:
+                self.manifest = []
+            self.created = not os.path.isfile(self.path)
+            self.archive, self.offset, self.names = self._open()
+            if not self.created:
+                with open(self.path, 'rb') as f:
+                    f.seek(self.offset)
+                    self.tail = f.read()
+        except:
+            self.filelock.release()
+            raise
+
+    def exists(self, name):
+        with self.lock:
+            return name in self.names
+
+    def add(self, filename, name, student_raw, attempt):
+        '''
+        Append ``filename`` to the archive as ``name``.
+        '''
+        with self.lock:
+            if self.broken:
+                raise RuntimeError('Cannot add to archive "{0}" after a previous error'.format(self.path))
+            if name in self.names:
+                raise RuntimeError('The assignment "{0}" already exists in archive "{1}"'.format(name, self.path))
+            try:
+                self._add(filename, name)
+            except:
+                self.broken = True
+                raise
+            self.names.add(name)
+            self.added.append({'student': student_raw, 'attempt': attempt, 'entry': name})
+
+    def close(self):
+        '''
+        Finish writing the archive and manifest.  They may still be rolled
+        back until ``commit()``.
+        '''
+        if self.broken:
+            raise RuntimeError('Archive "{0}" is incomplete due to a previous error'.format(self.path))
+        self.archive.close()
+        self.closed = True
+        with open(self.manifestfile, 'w', encoding='utf8') as f:
+            f.write(json.dumps(self.manifest + self.added, indent=2, ensure_ascii=False))
+            f.write('\n')
+
+    def commit(self):
+        self.filelock.release()
+
+    def rollback(self):
+        '''
+        Restore the archive and manifest to their state before ``open()``.
+        '''
+        try:
+            if not self.closed:
+                try:
+                    self.archive.close()
+                except Exception:
+                    pass
+            if self.created:
+                if os.path.isfile(self.path):
+                    os.remove(self.path)
+            else:
+                with open(self.path, 'r+b') as f:
+                    f.seek(self.offset)
+                    f.truncate()
+                    f.write(self.tail)
+            if self.closed:
+                if self.manifest:
+                    with open(self.manifestfile, 'w', encoding='utf8') as f:
+                        f.write(json.dumps(self.manifest, indent=2, ensure_ascii=False))
+                        f.write('\n')
+                elif os.path.isfile(self.manifestfile):
+                    os.remove(self.manifestfile)
+        finally:
+            self.filelock.release()
+
+    def _open(self):
+        '''
+        Open the archive for appending, returning the archive, the offset at
+        which new entries will be written, and the set of existing entry
+        names.
+        '''
+        raise NotImplementedError
+
+    def _add(self, filename, name):
+        raise NotImplementedError
+
+
+
+
+class ZipSink(ArchiveSink):
+    '''
+    Zip archive.  PDFs are already compressed, so entries are stored without
+    compression.
+    '''
+    extension = 'zip'
+
+    def _open(self):
+        if self.created:
+            z = zipfile.ZipFile(self.path, 'w', allowZip64=True)
+            return z, 0, set()
+        z = zipfile.ZipFile(self.path, 'a', allowZip64=True)
+        # New entries overwrite the central directory, which is rewritten
+        # when the archive is closed
+        return z, z.start_dir, set(z.namelist())
+
+    def _add(self, filename, name):
+        self.archive.write(filename, name, compress_type=zipfile.ZIP_STORED)
+
+
+
+
+class TarSink(ArchiveSink):
+    '''
+    Uncompressed tar archive.
+    '''
+    extension = 'tar'
+
+    def _open(self):
+        t = tarfile.open(self.path, 'a')
+        # New entries overwrite the end-of-archive blocks
+        return t, t.offset, set(t.getnames())
+
+    def _add(self, filename, name):
+        self.archive.add(filename, arcname=name)
+
+
+
+
+sinks = {'zip': ZipSink, 'tar': TarSink}
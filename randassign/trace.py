@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015, Geoffrey M. Poore
+# All rights reserved.
+#
+# Licensed under the BSD 3-Clause License:
+# http://opensource.org/licenses/BSD-3-Clause
+#
+
+
+'''
+Timeline of a run of ``make()`` in Chrome trace-event format, for viewing in
+``chrome://tracing`` or Perfetto.
+'''
+
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+
+import os
+import sys
+if sys.version_info.major == 2:
+    from io import open
+import time
+import json
+import threading
+import contextlib
+
+
+
+
+class Tracer(object):
+    '''
+    Collect complete ("X") events for spans of time.
+
+    Track 0 is used for the phases of the run, and each build slot has its own
+    track, so that simultaneous builds appear side by side.
+    '''
+    def __init__(self, name='randassign'):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.pid = os.getpid()
+        self.events = []
+        self.tracks = set()
+        self.metadata('process_name', 0, name)
+        self.track(0, 'main')
+
+    def metadata(self, name, tid, value):
+        with self.lock:
+            self.events.append({'name': name, 'ph': 'M', 'pid': self.pid,
+                                'tid': tid, 'args': {'name': value}})
+
+    def track(self, tid, name):
+        '''
+        Name a track, if it has not already been named.
+        '''
+        if tid not in self.tracks:
+            self.tracks.add(tid)
+            self.metadata('thread_name', tid, name)
+
+    def add(self, name, cat, start, end, tid=0, args=None):
+        '''
+        Add a span from ``start`` to ``end``, as given by ``time.time()``.
+        '''
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': self.pid,
+                 'tid': tid, 'ts': int((start - self.start)*1e6),
+                 'dur': int((end - start)*1e6)}
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, cat='phase', tid=0, **args):
+        '''
+        Context manager that records a span for its body.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, cat, start, time.time(), tid, args)
+
+    def write(self, tracefile):
+        '''
+        Save the trace, with a span for the whole run up to now.
+        '''
+        self.add('make', 'run', self.start, time.time())
+        with self.lock:
+            t = json.dumps({'traceEvents': self.events,
+                            'displayTimeUnit': 'ms'}, ensure_ascii=False)
+        with open(tracefile, 'w', encoding='utf8') as f:
+            f.write(t)
+            f.write('\n')
+
+
+
+
+class NullTracer(object):
+    '''
+    Tracer that records nothing, for runs without ``trace``.
+    '''
+    def track(self, tid, name):
+        pass
+
+    def add(self, name, cat, start, end, tid=0, args=None):
+        pass
+
+    @contextlib.contextmanager
+    def span(self, name, cat='phase', tid=0, **args):
+        yield
+
+    def write(self, tracefile):
+        pass
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015, Geoffrey M. Poore
+# All rights reserved.
+#
+# Licensed under the BSD 3-Clause License:
+# http://opensource.org/licenses/BSD-3-Clause
+#
+
+
+'''
+Watch mode, for rebuilding preview assignments while an assignment is being
+written.
+'''
+
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+
+import os
+import sys
+import shutil
+import time
+from .make import (_process_args, _MakeRun, _make_builddir, _BuildSlot, _texinputs,
+                   _check_directory_structure, _load_students, _parsestudentfile,
+                   _parsestudentname, _rosterfile)
+
+
+
+
+def _watched_files(texfile, studentfile):
+    '''
+    Return the tex file, its local inputs, and the student file, as absolute
+    paths.
+    '''
+    return _texinputs(texfile) + [os.path.abspath(studentfile)]
+
+
+def _mtimes(files):
+    mtimes = {}
+    for f in files:
+        try:
+            mtimes[f] = os.stat(f).st_mtime
+        except OSError:
+            mtimes[f] = None
+    return mtimes
+
+
+
+
+def watch(poll=0.5, **kwargs):
+    '''
+    Build preview assignments, then rebuild them whenever the tex file, any
+    file it includes via ``\\input`` or ``\\include``, or the student file
+    changes.  Runs until interrupted with Ctrl+C.
+
+    Accepts the same keyword arguments as ``make()``.  Preview assignments are
+    built for ``student`` if given, and otherwise for the first ``preview``
+    students in the student file.  They are saved under
+    ``<randassigndir>/preview``, with separate data and solutions that are
+    replaced by each rebuild, so previews never create attempts in the real
+    data file.  The solutions are regenerated after each rebuild.
+
+    Between rebuilds, the arguments, the private build directories (with
+    their LaTeX and PythonTeX files), and the parsed student file are kept,
+    so that each rebuild only runs LaTeX and PythonTeX.  ``poll`` is the
+    interval in seconds for checking files for changes.
+    '''
+    a = _process_args(kwargs)
+    previewdir = os.path.join(a.randassigndir, 'preview')
+    solndir = os.path.join(previewdir, 'solutions')
+    # Previews replace each other, so there is only ever a single attempt, and
+    # failures are reported without stopping the watch
+    pa = a._replace(watch=False, randassigndir=previewdir,
+                    assigndir=os.path.join(previewdir, 'assignments'),
+                    solndir=solndir,
+                    solnfile=os.path.join(solndir, os.path.basename(a.solnfile)),
+                    randassigndatafile=os.path.join(solndir, os.path.basename(a.randassigndatafile)),
+                    multipleattempts=False, keepgoing=True, retries=0,
+                    schedule='roster', assignsink='dir', bundle=False,
+                    trace=None)
+    if not (os.path.isabs(pa.namefile) or os.path.isabs(pa.attemptfile)):
+        pa = pa._replace(isolate=True)
+    texfile = os.path.join(a.texdir, a.texfile)
+    studentfile = a.studentfile
+
+    slots = None
+    try:
+        while True:
+            files = _watched_files(texfile, studentfile)
+            mtimes = _mtimes(files)
+            slots = _rebuild(pa, slots)
+            if not a.silent:
+                print('Watching {0} file(s) for changes (Ctrl+C to stop)'.format(len(files)))
+            while True:
+                time.sleep(poll)
+                current = _mtimes(files)
+                if current != mtimes:
+                    # Wait for editors to finish saving
+                    time.sleep(poll)
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if slots is not None:
+            for slot in slots:
+                if slot.private:
+                    shutil.rmtree(slot.dir, ignore_errors=True)
+
+
+def _rebuild(pa, slots):
+    '''
+    Rebuild the preview assignments and solutions, using ``slots`` if they
+    exist.  Return the slots for the next rebuild.
+    '''
+    start = time.time()
+    run = _MakeRun(pa)
+    # Previous previews are replaced
+    if os.path.isdir(pa.assigndir):
+        shutil.rmtree(pa.assigndir)
+    if os.path.isfile(pa.randassigndatafile):
+        os.remove(pa.randassigndatafile)
+    results = []
+    try:
+        if pa.parsestudentfile is _parsestudentfile and pa.parsestudentname is _parsestudentname:
+            _check_directory_structure(pa.solndir)
+            rosterfile = _rosterfile(pa)
+        else:
+            rosterfile = None
+        students = _load_students(pa.student, pa.studentfile, pa.parsestudentfile, pa.parsestudentname, rosterfile)
+        if pa.student is None:
+            # Only the previewed students are checked by preflight
+            students = tuple(x[:pa.preview] for x in students)
+        run.start(students)
+        if slots is None:
+            if pa.isolate:
+                slots = [_BuildSlot(pa, _make_builddir(pa.randassigndir, pa.scratchdir), index=k)
+                         for k in range(1, run.jobs()+1)]
+            else:
+                slots = [_BuildSlot(pa)]
+        # The document has changed, so the PythonTeX code needs to be
+        # extracted again
+        for slot in slots:
+            slot.primed = False
+        for r in run.iterbuild(slots):
+            results.append(r)
+        run.finish()
+    except Exception as e:
+        run.rollback()
+        if not pa.silent:
+            print('Preview failed:  {0}'.format(e), file=sys.stderr)
+        return slots
+    except:
+        run.rollback()
+        raise
+    if not pa.silent:
+        failed = [r for r in results if r.error is not None]
+        print('Built {0} preview assignment(s) in {1:.1f} s{2}'.format(len(results) - len(failed), time.time() - start,
+                                                                    ', {0} failed'.format(len(failed)) if failed else ''))
+        for r in results:
+            if r.error is None:
+                print('  {0}'.format(r.assignment))
+    return slots
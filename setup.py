@@ -25,7 +25,7 @@ try:
     from setuptools import setup
     setup_package_dependent_keywords = dict(
         entry_points = {
-            'console_scripts': ['randassign = randassign.make:make'],
+            'console_scripts': ['randassign = randassign.make:main'],
         },
     )
 except ImportError: